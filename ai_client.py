@@ -1,9 +1,56 @@
-import aiohttp
 import json
 import logging
-from config import POE_API_KEY, POE_BASE_URL
+import re
+from config import POE_BASE_URL, IMAGE_BOT_MODELS
+from http_session import get_session
+from key_pool import key_pool
+from request_body import DataUrl, JsonStreamPayload
 from typing import Dict, Any, List
 
+MD_IMAGE_RE = re.compile(r"!\[[^\]]*\]\(\s*(https?://[^\s)]+|data:image/[\w.+-]+;base64,[A-Za-z0-9+/=]+)\s*\)")
+DATA_URL_RE = re.compile(r"data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=]+)")
+CODE_SPAN_RE = re.compile(r"(```[\s\S]*?```|`[^`\n]+`)")
+
+def image_attachment(url: str) -> dict:
+    m = DATA_URL_RE.fullmatch(url)
+    if m:
+        mime = m.group(1)
+        return {"filename": "image." + mime.split("/")[1].split("+")[0], "content_type": mime, "data_base64": m.group(2)}
+    return {"filename": url.rsplit("/", 1)[-1].split("?")[0] or "image", "url": url}
+
+def extract_images(content, model: str) -> tuple[str, list[dict]]:
+    # Only image bots produce pictures; anything that looks like one in other
+    # replies is just text the model wrote and must never be fetched.
+    extract = model in IMAGE_BOT_MODELS
+    attachments = []
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url" and extract:
+                url = (part.get("image_url") or {}).get("url")
+                if url:
+                    attachments.append(image_attachment(url))
+        content = "\n".join(texts)
+    if not extract or not content or ("![" not in content and "data:image/" not in content):
+        return content or "", attachments
+
+    def take(m):
+        attachments.append(image_attachment(m.group(1)))
+        return ""
+
+    def take_data(m):
+        attachments.append(image_attachment(m.group(0)))
+        return ""
+
+    # Odd indices are code spans and stay untouched.
+    pieces = CODE_SPAN_RE.split(content)
+    for i in range(0, len(pieces), 2):
+        pieces[i] = DATA_URL_RE.sub(take_data, MD_IMAGE_RE.sub(take, pieces[i]))
+    content = "".join(pieces)
+    return (content.strip() if attachments else content), attachments
+
 class PoeChatClient:
     async def chat(self, model: str, messages: list[dict], request_id: str = "N/A") -> Dict[str, Any]:
         openai_messages = []
@@ -23,10 +70,13 @@ class PoeChatClient:
             
             for att in attachments:
                 mime = att.get("content_type", "application/octet-stream")
-                b64 = att.get("data_base64", "")
                 filename = att.get("filename", "file")
+
+                if "text" in att:
+                    content_parts.append({"type": "text", "text": f"Файл {filename}:\n\n{att['text']}"})
+                    continue
                 
-                data_url = f"data:{mime};base64,{b64}"
+                data_url = DataUrl(mime, att["source"])
                 
                 if mime.startswith("image/"):
                     content_parts.append({
@@ -50,21 +100,34 @@ class PoeChatClient:
             "stream": False
         }
 
-        logging.info(f"[{request_id}] Sending POST request to Poe API ({POE_BASE_URL}/chat/completions) for model: {model}")
-        async with aiohttp.ClientSession() as session:
+        tried = []
+        while True:
+            key = key_pool.acquire(exclude=tried)
+            tried.append(key)
+            logging.info("[%s] Sending POST request to Poe API (%s/chat/completions) for model: %s with key %s", request_id, POE_BASE_URL, model, key.label)
+            session = get_session()
             async with session.post(
                 f"{POE_BASE_URL}/chat/completions",
                 headers={
-                    "Authorization": f"Bearer {POE_API_KEY}",
+                    "Authorization": f"Bearer {key.key}",
                     "Content-Type": "application/json",
                     "Accept-Encoding": "gzip, deflate"
                 },
-                json=payload
+                data=JsonStreamPayload(payload)
             ) as resp:
-                logging.info(f"[{request_id}] Received response from Poe API. Status: {resp.status}")
+                logging.info("[%s] Received response from Poe API. Status: %s", request_id, resp.status)
+                if resp.status in (402, 429):
+                    if resp.status == 429:
+                        retry_after = resp.headers.get("Retry-After")
+                        key_pool.report_rate_limit(key, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                    else:
+                        key_pool.mark_exhausted(key)
+                    if len(tried) < len(key_pool.keys):
+                        logging.warning("[%s] Key %s rejected with %s, trying another key", request_id, key.label, resp.status)
+                        continue
                 if resp.status != 200:
                     error_text = await resp.text()
-                    logging.error(f"[{request_id}] Poe API Error Body: {error_text}")
+                    logging.error("[%s] Poe API Error Body: %s", request_id, error_text)
                     raise Exception(f"Poe API Error {resp.status}: {error_text}")
                 
                 data = await resp.json()
@@ -74,13 +137,15 @@ class PoeChatClient:
                     text_response = ""
                 else:
                     text_response = choices[0].get("message", {}).get("content", "")
-                
+
+                text_response, image_attachments = extract_images(text_response, model)
                 usage = data.get("usage", {})
                 
                 return {
                     "text": text_response,
-                    "attachments": [],
+                    "attachments": image_attachments,
                     "usage": usage,
                     "id": data.get("id"),
-                    "created": data.get("created")
+                    "created": data.get("created"),
+                    "key": key
                 }
\ No newline at end of file
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from config import ALBUM_COLLECT_DELAY
+
+class AlbumBuffer:
+    def __init__(self):
+        self.messages = []
+        self.created = time.monotonic()
+        self.last_added = self.created
+
+class AlbumCollector:
+    def __init__(self, delay: float = ALBUM_COLLECT_DELAY, max_age: float = 60):
+        self.delay = delay
+        self.max_age = max_age
+        self.groups = {}
+
+    def add(self, message):
+        now = time.monotonic()
+        for group_id in [g for g, buf in self.groups.items() if now - buf.created > self.max_age]:
+            del self.groups[group_id]
+        buf = self.groups.setdefault(message.media_group_id, AlbumBuffer())
+        if all(m.message_id != message.message_id for m in buf.messages):
+            buf.messages.append(message)
+        buf.last_added = now
+        return buf
+
+    async def collect(self, message) -> list:
+        buf = self.add(message)
+        while True:
+            wait = buf.last_added + self.delay - time.monotonic()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        if self.groups.get(message.media_group_id) is buf:
+            del self.groups[message.media_group_id]
+        return sorted(buf.messages, key=lambda m: m.message_id)
+
+album_collector = AlbumCollector()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.client.session.aiohttp import AiohttpSession
+from config import TELEGRAM_BOT_TOKEN, UPLOAD_PROXY_URL, SHUTDOWN_DRAIN_TIMEOUT
+import handlers_shared
+from command_handlers import router as command_router
+from chat_handlers import router as chat_router, cancel_non_economy_requests
+from poe_balance import balance_cache
+from log_partitions import log_partitions
+from lifecycle import inflight
+from http_session import close_session
+from document_text import shutdown_executor
+from budgets import budgets
+from update_ledger import update_ledger
+from memory_diagnostics import memory_diagnostics
+
+def configure_proxy_env():
+    current_no_proxy = os.environ.get("NO_PROXY", "")
+    if "api.telegram.org" not in current_no_proxy:
+        os.environ["NO_PROXY"] = ",".join(filter(None, [current_no_proxy, "api.telegram.org"]))
+
+def create_bot() -> Bot:
+    session = AiohttpSession(
+        proxy=UPLOAD_PROXY_URL,
+        timeout=60.0
+    )
+
+    return Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2),
+        session=session
+    )
+
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    
+    dp.include_router(command_router)
+    dp.include_router(chat_router)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+async def start_services(primary: bool = True):
+    await asyncio.to_thread(handlers_shared.init)
+    balance_cache.start()
+    if primary:
+        # Only one process owns the budget rows; the others mirror its buckets
+        # through broadcast charges so a user cannot get the limit once per worker.
+        log_partitions.start()
+        budgets.start(handlers_shared.db.save_budget_buckets)
+    update_ledger.start(handlers_shared.db)
+    memory_diagnostics.start()
+
+def apply_event(event: dict):
+    kind = event["type"]
+    if kind == "economy":
+        handlers_shared.economy_mode = event["enabled"]
+        if event["enabled"]:
+            cancel_non_economy_requests()
+    elif kind == "budget_charge":
+        budgets.charge(event["user_id"], event["chat_id"], event["points"])
+    elif kind == "budget_override":
+        budgets.set_override(event["scope"], event["entity_id"], event["capacity"])
+    else:
+        logging.warning("Unknown worker event: %s", kind)
+
+async def on_shutdown():
+    logging.info("Polling stopped, draining in-flight requests...")
+    await inflight.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    balance_cache.stop()
+    log_partitions.stop()
+    update_ledger.stop()
+    memory_diagnostics.stop()
+    await budgets.stop()
+    await close_session()
+    shutdown_executor()
+    await asyncio.to_thread(handlers_shared.db.close)
+    logging.info("Shutdown complete.")
\ No newline at end of file
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from config import USER_BUDGET_POINTS, USER_BUDGET_PERIOD, CHAT_BUDGET_POINTS, CHAT_BUDGET_PERIOD, BUDGET_CHECKPOINT_INTERVAL
+
+SCOPES = {
+    "user": (USER_BUDGET_POINTS, USER_BUDGET_PERIOD),
+    "chat": (CHAT_BUDGET_POINTS, CHAT_BUDGET_PERIOD),
+}
+UNLIMITED = -1
+
+class TokenBucket:
+    def __init__(self, tokens: float | None = None, updated: float | None = None, capacity_override: int | None = None):
+        self.tokens = tokens
+        self.updated = updated or time.time()
+        self.capacity_override = capacity_override
+        self.dirty = False
+
+class BudgetManager:
+    def __init__(self):
+        self.buckets = {}
+        self.task = None
+        self.save = None
+
+    def capacity(self, scope: str, bucket: TokenBucket | None) -> int:
+        if bucket is not None and bucket.capacity_override is not None:
+            return bucket.capacity_override
+        default = SCOPES[scope][0]
+        return default if default > 0 else UNLIMITED
+
+    def bucket(self, scope: str, entity_id: int) -> TokenBucket:
+        bucket = self.buckets.get((scope, entity_id))
+        if bucket is None:
+            bucket = self.buckets[(scope, entity_id)] = TokenBucket()
+        capacity = self.capacity(scope, bucket)
+        now = time.time()
+        if bucket.tokens is None:
+            bucket.tokens = float(max(capacity, 0))
+        elif capacity > 0:
+            rate = capacity / SCOPES[scope][1]
+            bucket.tokens = min(float(capacity), bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        return bucket
+
+    def limited_scopes(self, user_id: int, chat_id: int):
+        scopes = [("user", user_id)] if user_id == chat_id else [("user", user_id), ("chat", chat_id)]
+        for scope, entity_id in scopes:
+            if self.capacity(scope, self.buckets.get((scope, entity_id))) != UNLIMITED:
+                yield scope, entity_id
+
+    def check(self, user_id: int, chat_id: int) -> tuple[str, float] | None:
+        for scope, entity_id in self.limited_scopes(user_id, chat_id):
+            bucket = self.bucket(scope, entity_id)
+            if bucket.tokens > 0:
+                continue
+            capacity = self.capacity(scope, bucket)
+            if capacity == 0:
+                return scope, float("inf")
+            rate = capacity / SCOPES[scope][1]
+            return scope, (1 - bucket.tokens) / rate
+        return None
+
+    def charge(self, user_id: int, chat_id: int, points: int):
+        for scope, entity_id in self.limited_scopes(user_id, chat_id):
+            bucket = self.bucket(scope, entity_id)
+            bucket.tokens -= points
+            bucket.dirty = True
+
+    def set_override(self, scope: str, entity_id: int, capacity: int | None):
+        bucket = self.bucket(scope, entity_id)
+        bucket.capacity_override = capacity
+        effective = self.capacity(scope, bucket)
+        if effective >= 0:
+            bucket.tokens = min(bucket.tokens, float(effective))
+        bucket.dirty = True
+        return bucket
+
+    def load(self, rows: list[tuple]):
+        for scope, entity_id, tokens, updated, capacity_override in rows:
+            self.buckets[(scope, entity_id)] = TokenBucket(tokens, updated, capacity_override)
+
+    def take_dirty(self) -> list[tuple]:
+        rows = []
+        for (scope, entity_id), bucket in self.buckets.items():
+            if bucket.dirty:
+                bucket.dirty = False
+                rows.append((scope, entity_id, bucket.tokens, bucket.updated, bucket.capacity_override))
+        return rows
+
+    async def checkpoint(self):
+        if self.save is None:
+            return
+        rows = self.take_dirty()
+        if not rows:
+            return
+        try:
+            await asyncio.to_thread(self.save, rows)
+        except Exception:
+            for scope, entity_id, *_ in rows:
+                self.buckets[(scope, entity_id)].dirty = True
+            raise
+
+    def start(self, save):
+        self.save = save
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.checkpoint_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.checkpoint()
+
+    async def checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(BUDGET_CHECKPOINT_INTERVAL)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                logging.error("Budget checkpoint failed: %s", e)
+
+def format_duration(seconds: float) -> str:
+    if seconds == float("inf"):
+        return "никогда (бюджет отключен администратором)"
+    seconds = max(1, int(seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин"
+    return f"{secs} с"
+
+budgets = BudgetManager()
@@ -3,8 +3,10 @@ import re
 import os
 import logging
 import io
-import base64
 import mimetypes
+import tempfile
+import time
+from contextlib import asynccontextmanager
 import aiohttp
 import json
 from aiogram import Router, F
@@ -12,26 +14,43 @@ from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, B
 from aiogram.enums import ChatAction, ParseMode
 from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramBadRequest
 import telegramify_markdown
-from config import BOT_CONFIGS, CONTEXT_MAX_MESSAGES, POE_API_KEY, ADMIN_CHAT_ID, ECONOMY_BOTS, UPLOAD_PROXY_URL
+from config import BOT_CONFIGS, CONTEXT_MAX_MESSAGES, ADMIN_CHAT_ID, ECONOMY_BOTS, UPLOAD_PROXY_URL, FANOUT_TRIGGERS, FANOUT_MODELS, FANOUT_TIMEOUT
 from handlers_shared import db
 import handlers_shared
 from ai_client import PoeChatClient
-from utils import post_process_response_text, markdown_normalize, sanitize_and_chunk_text, chunk_text
+from profiler import profiler
+from lifecycle import inflight, model_requests, ModelRequest
+from poe_balance import balance_cache
+from key_pool import PoeKey
+from cost_model import cost_model
+from image_outputs import send_image_outputs, SPOOL_MAX_BYTES
+from request_body import Base64Source
+from albums import album_collector
+from image_preprocess import pick_photo_size, image_target, preprocess_image
+from document_text import is_text_document, document_cache, document_text, text_attachment
+from budgets import budgets, format_duration
+from update_ledger import update_ledger
+from markdown_v2 import repair_markdown_v2, plain_text, markdown_stats
+from utils import clean_response_text, sanitize_and_chunk_text, chunk_text
 from aiogram.filters import Command, CommandObject
 
 router = Router()
 ai = PoeChatClient()
 
-async def get_points_cost(query_id: str, created: int, bot_name: str, request_id: str = "N/A") -> int | None:
+CHAT_ACTION_INTERVAL = 4.5
+# Registry label for a fan-out before its per-model requests exist.
+FANOUT_REQUEST = "fan-out"
+
+async def get_points_cost(query_id: str, created: int, bot_name: str, key: PoeKey, request_id: str = "N/A") -> int | None:
     headers = {
-        "Authorization": f"Bearer {POE_API_KEY}",
+        "Authorization": f"Bearer {key.key}",
         "Accept-Encoding": "gzip, deflate"
     }
     url = "https://api.poe.com/usage/points_history"
     
     for i in range(3):
         try:
-            logging.info(f"[{request_id}] Fetching points history (attempt {i+1}) for query_id={query_id} (async)...")
+            logging.info("[%s] Fetching points history (attempt %s) for query_id=%s (async)...", request_id, i + 1, query_id)
             async with aiohttp.ClientSession() as session:
                 async with session.get(
                     url,
@@ -39,7 +58,7 @@ async def get_points_cost(query_id: str, created: int, bot_name: str, request_id
                     params={"limit": 50},
                     timeout=10
                 ) as resp:
-                    logging.info(f"[{request_id}] Points history response status: {resp.status}")
+                    logging.info("[%s] Points history response status: %s", request_id, resp.status)
                     if resp.status == 200:
                         data = await resp.json()
                         entries = data.get("data", [])
@@ -62,7 +81,7 @@ async def get_points_cost(query_id: str, created: int, bot_name: str, request_id
                         pass
                 
         except Exception as e:
-            logging.error(f"[{request_id}] Error fetching points cost: {e}")
+            logging.error("[%s] Error fetching points cost: %s", request_id, e)
             pass
         
         if i < 2:
@@ -70,6 +89,14 @@ async def get_points_cost(query_id: str, created: int, bot_name: str, request_id
             
     return None
 
+async def calibrate_cost(query_id: str, created: int, bot_name: str, key: PoeKey, usage: dict, request_id: str = "N/A") -> int | None:
+    points_cost = await get_points_cost(query_id, created, bot_name, key, request_id=request_id)
+    if points_cost is not None:
+        stats = cost_model.observe(bot_name, usage, points_cost)
+        if stats:
+            await asyncio.to_thread(db.save_cost_model, bot_name, stats)
+    return points_cost
+
 def build_trigger_map():
     m = {}
     for triggers, model in BOT_CONFIGS.items():
@@ -82,23 +109,33 @@ def sorted_triggers():
     t.sort(key=len, reverse=True)
     return t
 
-def extract_trigger_and_text(text):
-    if not text:
-        return None, None, None
-    tmap = build_trigger_map()
+def split_trigger(text, triggers):
     lower = text.lower()
-    for trig in sorted_triggers():
+    for trig in triggers:
         if not lower.startswith(trig):
             continue
         if len(lower) == len(trig):
-            content = text[len(trig):].strip()
-            return trig, tmap[trig], content
+            return trig, text[len(trig):].strip()
         nxt = lower[len(trig)]
-        if nxt.isalnum():
+        if nxt.isalnum() and trig[-1].isalnum():
             continue
-        content = text[len(trig):].lstrip(" \t,.:;|/-----")
-        return trig, tmap[trig], content
-    return None, None, None
+        return trig, text[len(trig):].lstrip(" \t,.:;|/-----")
+    return None, None
+
+def extract_fanout_text(text):
+    trig, content = split_trigger(text, FANOUT_TRIGGERS)
+    if trig and trig.startswith("/") and content.startswith("@"):
+        # "/all@SomeBot question" in groups: drop the bot mention.
+        content = content.partition(" ")[2].strip()
+    return trig, content
+
+def extract_trigger_and_text(text):
+    if not text:
+        return None, None, None
+    trig, content = split_trigger(text, sorted_triggers())
+    if not trig:
+        return None, None, None
+    return trig, build_trigger_map()[trig], content
 
 def is_clear_command(s):
     if not s:
@@ -110,6 +147,10 @@ def is_clear_command(s):
 async def safe_reply_markdown(message: Message, text: str, request_id: str = "N/A"):
     if not text:
         return
+    async with profiler.profile(request_id, "safe_reply_markdown"):
+        await send_markdown_parts(message, text, request_id)
+
+async def send_markdown_parts(message: Message, text: str, request_id: str):
     chat_id = message.chat.id
     use_collapsible_quote = False
     if chat_id is not None:
@@ -137,28 +178,33 @@ async def safe_reply_markdown(message: Message, text: str, request_id: str = "N/
         parts = sanitize_and_chunk_text(text)
     
     for i, part in enumerate(parts):
+        part, status = repair_markdown_v2(part)
+        markdown_stats[status] += 1
+        if status != "valid":
+            logging.info("[%s] MarkdownV2 in part %s was invalid, sending it %s", request_id, i + 1, status)
+        parse_mode = None if status == "plain" else ParseMode.MARKDOWN_V2
         max_retries = 10
         for attempt in range(max_retries):
             try:
-                logging.info(f"[{request_id}] Sending message part {i+1}/{len(parts)} to chat {chat_id} (attempt {attempt+1})...")
+                logging.info("[%s] Sending message part %s/%s to chat %s (attempt %s)...", request_id, i + 1, len(parts), chat_id, attempt + 1)
                 if i == 0:
-                    await message.reply(part, parse_mode=ParseMode.MARKDOWN_V2)
+                    await message.reply(part, parse_mode=parse_mode)
                 else:
-                    await message.answer(part, parse_mode=ParseMode.MARKDOWN_V2)
-                logging.info(f"[{request_id}] Message part {i+1} sent successfully.")
+                    await message.answer(part, parse_mode=parse_mode)
+                logging.info("[%s] Message part %s sent successfully.", request_id, i + 1)
                 break
             except TelegramRetryAfter as e:
-                logging.warning(f"[{request_id}] Flood limit exceeded. Waiting {e.retry_after} seconds.")
+                logging.warning("[%s] Flood limit exceeded. Waiting %s seconds.", request_id, e.retry_after)
                 await asyncio.sleep(e.retry_after)
                 continue
             except TelegramNetworkError as e:
                 wait_time = (attempt + 1) * 2
-                logging.warning(f"[{request_id}] Attempt {attempt + 1}/{max_retries} failed to send message: {e}. Retrying in {wait_time}s...")
+                logging.warning("[%s] Attempt %s/%s failed to send message: %s. Retrying in %ss...", request_id, attempt + 1, max_retries, e, wait_time)
                 if attempt < max_retries - 1:
                     await asyncio.sleep(wait_time)
                     continue
                 else:
-                    logging.exception(f"[{request_id}] All retry attempts failed for message part.", exc_info=e)
+                    logging.exception("[%s] All retry attempts failed for message part.", request_id, exc_info=e)
                     try:
                         if i == 0:
                             await message.reply("Error: Operation timed out or network error.")
@@ -168,19 +214,20 @@ async def safe_reply_markdown(message: Message, text: str, request_id: str = "N/
                         pass
             except TelegramBadRequest as e:
                 if "can't parse entities" in str(e).lower():
-                    logging.warning(f"[{request_id}] MarkdownV2 parse error, falling back to plain text: %s", e)
+                    markdown_stats["rejected"] += 1
+                    logging.warning("[%s] MarkdownV2 parse error missed by local validation, falling back to plain text: %s", request_id, e)
                     try:
-                        plain = re.sub(r"\\([_*[]()~`>#+\-=|{}.!])", r"\1", part)
-                        logging.info(f"[{request_id}] Sending fallback plain text message...")
+                        plain = plain_text(part)
+                        logging.info("[%s] Sending fallback plain text message...", request_id)
                         if i == 0:
                             await message.reply(plain, parse_mode=None)
                         else:
                             await message.answer(plain, parse_mode=None)
-                        logging.info(f"[{request_id}] Fallback message sent.")
+                        logging.info("[%s] Fallback message sent.", request_id)
                     except Exception as e2:
-                        logging.exception(f"[{request_id}] Failed to send plain text fallback", exc_info=e2)
+                        logging.exception("[%s] Failed to send plain text fallback", request_id, exc_info=e2)
                         try:
-                            fallback_text = "Ошибка форматирования ответа, отправляю как обычный текст:\n\n" + re.sub(r"\\([_*[]()~`>#+\-=|{}.!])", r"\1", part)
+                            fallback_text = "Ошибка форматирования ответа, отправляю как обычный текст:\n\n" + plain_text(part)
                             if i == 0:
                                 await message.reply(fallback_text, parse_mode=None)
                             else:
@@ -188,20 +235,20 @@ async def safe_reply_markdown(message: Message, text: str, request_id: str = "N/
                         except Exception:
                             pass
                 else:
-                    logging.exception(f"[{request_id}] BadRequest when sending message", exc_info=e)
+                    logging.exception("[%s] BadRequest when sending message", request_id, exc_info=e)
                     try:
-                        logging.info(f"[{request_id}] Sending sanitized fallback message...")
-                        sanitized_text = re.sub(r"\\([_*[]()~`>#+\-=|{}.!])", r"\1", part)
+                        logging.info("[%s] Sending sanitized fallback message...", request_id)
+                        sanitized_text = plain_text(part)
                         if i == 0:
                             await message.reply(sanitized_text, parse_mode=None)
                         else:
                             await message.answer(sanitized_text, parse_mode=None)
-                        logging.info(f"[{request_id}] Fallback message sent.")
+                        logging.info("[%s] Fallback message sent.", request_id)
                     except Exception:
                         pass
                 break
             except Exception as e:
-                logging.exception(f"[{request_id}] Unexpected error sending message", exc_info=e)
+                logging.exception("[%s] Unexpected error sending message", request_id, exc_info=e)
                 try:
                     if i == 0:
                         await message.reply(f"Error: {e}")
@@ -211,6 +258,23 @@ async def safe_reply_markdown(message: Message, text: str, request_id: str = "N/
                     pass
                 break
 
+async def keep_chat_action(message: Message, action: ChatAction, request_id: str):
+    while True:
+        try:
+            await message.bot.send_chat_action(chat_id=message.chat.id, action=action)
+        except Exception as e:
+            logging.warning("[%s] Failed to send %s: %s", request_id, action, e)
+        await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+@asynccontextmanager
+async def chat_action(message: Message, action: ChatAction, request_id: str):
+    # Telegram shows an action for about 5 seconds, so it is resent until the block exits.
+    task = asyncio.create_task(keep_chat_action(message, action, request_id))
+    try:
+        yield
+    finally:
+        task.cancel()
+
 async def ensure_whitelisted_or_prompt(message: Message):
     chat = message.chat
     user = message.from_user
@@ -261,171 +325,441 @@ async def handle_clear_command(message: Message, command: CommandObject):
         await message.reply("Неизвестный триггер или модель")
         return
     chat_id = message.chat.id
+    model_requests.cancel_model(chat_id, model, "context cleared")
     await asyncio.to_thread(db.clear_context, chat_id, model)
     await message.reply(f"Контекст очищен для {model}")
 
+def attachment_source_of(message: Message, model: str):
+    if message.photo:
+        return pick_photo_size(message.photo, model)
+    if message.video:
+        return message.video
+    if message.document:
+        return message.document
+    return None
+
+async def download_attachment(message: Message, attachment_source, model: str, req_id: str) -> tuple[dict, int]:
+    file_name = getattr(attachment_source, 'file_name', None) or 'attachment.dat'
+    
+    mime_type = "application/octet-stream"
+    if hasattr(attachment_source, 'mime_type') and attachment_source.mime_type:
+        mime_type = attachment_source.mime_type
+    else:
+        guessed, _ = mimetypes.guess_type(file_name)
+        if guessed:
+            mime_type = guessed
+        elif message.photo:
+            mime_type = "image/jpeg"
+        elif message.video:
+            mime_type = "video/mp4"
+
+    extract_as_text = bool(message.document) and is_text_document(file_name, mime_type)
+    if extract_as_text:
+        cached = document_cache.get(attachment_source.file_unique_id)
+        if cached is not None:
+            logging.info("[%s] Using cached text of %s", req_id, file_name)
+            return text_attachment(file_name, cached), 0
+
+    logging.info("[%s] Downloading file from Telegram: %s", req_id, attachment_source.file_id)
+    file_info = await message.bot.get_file(attachment_source.file_id)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    await message.bot.download_file(file_info.file_path, spool)
+    logging.info("[%s] File downloaded successfully.", req_id)
+    size = spool.seek(0, io.SEEK_END)
+
+    if not extract_as_text and not mime_type.startswith("image/"):
+        return {
+            "filename": file_name,
+            "content_type": mime_type,
+            "source": Base64Source(spool, size)
+        }, 0
+
+    spool.seek(0)
+    file_bytes = spool.read()
+    spool.close()
+
+    if extract_as_text:
+        text = await document_text(file_bytes, file_name, mime_type, attachment_source.file_unique_id, request_id=req_id)
+        if text is not None:
+            logging.info("[%s] Inlined %s chars of text from %s", req_id, len(text), file_name)
+            return text_attachment(file_name, text), 0
+
+    bytes_saved = 0
+    if message.photo:
+        bytes_saved = (message.photo[-1].file_size or 0) - len(file_bytes)
+    if mime_type.startswith("image/"):
+        # Documents arrive as sent; shrink_image leaves small, upright ones alone.
+        needs_resize = True
+        if message.photo:
+            needs_resize = max(attachment_source.width, attachment_source.height) > image_target(model)[0]
+        if needs_resize:
+            original_size = len(file_bytes)
+            file_bytes, mime_type = await preprocess_image(file_bytes, mime_type, model, request_id=req_id)
+            bytes_saved += original_size - len(file_bytes)
+
+    return {
+        "filename": file_name,
+        "content_type": mime_type,
+        "source": Base64Source(io.BytesIO(file_bytes), len(file_bytes))
+    }, bytes_saved
+
+@router.message(F.media_group_id, ~F.caption)
+async def handle_album_part(message: Message):
+    album_collector.add(message)
+
 @router.message(F.text | F.caption)
 async def handle_message(message: Message):
-    req_id = f"msg_{message.message_id}"
+    await run_message(message, f"msg_{message.message_id}")
+
+@router.edited_message(F.text | F.caption)
+async def handle_edited_message(message: Message):
+    reqs = model_requests.cancel_message(message.chat.id, message.message_id, "prompt edited")
+    if not reqs:
+        return
+    album = next((req.album for req in reqs if req.album), None)
+    if album:
+        album = [message if m.message_id == message.message_id else m for m in album]
+    await asyncio.wait({req.task for req in reqs}, timeout=10)
+    await update_ledger.release(message.chat.id, message.message_id)
+    await run_message(message, f"edit_{message.message_id}", album)
+
+async def run_message(message: Message, req_id: str, album: list | None = None):
+    task = asyncio.current_task()
+    with inflight.track():
+        async with profiler.profile(req_id, "handle_message"):
+            try:
+                await process_message(message, req_id, album)
+            except asyncio.CancelledError:
+                req = model_requests.by_task.get(task)
+                if req is None or req.reason is None:
+                    raise
+                task.uncancel()
+                logging.info("[%s] Request cancelled: %s", req_id, req.reason)
+            finally:
+                model_requests.discard(task)
+
+def cancel_non_economy_requests() -> int:
+    # A fan-out placeholder is left alone: process_fanout re-filters its models
+    # before calling them, so the economy bots in it still answer.
+    return model_requests.cancel_where(lambda r: r.model != FANOUT_REQUEST and r.model not in ECONOMY_BOTS, "economy mode enabled")
+
+async def reply_economy_notice(message: Message):
+    allowed_triggers = []
+    for triggers, m in BOT_CONFIGS.items():
+        if m in ECONOMY_BOTS:
+            allowed_triggers.extend(triggers)
+    allowed_triggers = list(dict.fromkeys(allowed_triggers))
+    if allowed_triggers:
+        await message.reply("Сейчас включен режим экономии очков. Доступны боты: " + ", ".join(allowed_triggers) + ". Пожалуйста, используйте один из них.")
+    else:
+        await message.reply("Сейчас включен режим экономии очков. Пожалуйста, используйте доступные боты.")
+
+async def check_request_allowed(message: Message, content: str) -> bool:
+    if not content and not (message.photo or message.video or message.document):
+        await message.reply("Введите запрос после триггера или прикрепите файл.")
+        return False
+
+    exhausted = budgets.check(message.from_user.id, message.chat.id)
+    if exhausted:
+        scope, wait = exhausted
+        who = "Ваш бюджет очков" if scope == "user" else "Бюджет очков этого чата"
+        await message.reply(f"{who} исчерпан, восстановится через {format_duration(wait)}.", parse_mode=None)
+        return False
+    return True
+
+async def collect_attachments(message: Message, model: str, req_id: str, request: ModelRequest) -> list[dict] | None:
+    album = [message]
+    if message.media_group_id:
+        if request.album is None:
+            request.album = await album_collector.collect(message)
+            logging.info("[%s] Collected album %s with %s items", req_id, message.media_group_id, len(request.album))
+        album = request.album
+
+    sources = [(m, attachment_source_of(m, model)) for m in album]
+    sources = [(m, src) for m, src in sources if src]
+    if not sources:
+        return []
+    try:
+        async with chat_action(message, ChatAction.UPLOAD_DOCUMENT, req_id):
+            downloaded = await asyncio.gather(*(download_attachment(m, src, model, req_id) for m, src in sources))
+    except Exception as e:
+        logging.exception("[%s] Не удалось обработать вложение", req_id, exc_info=e)
+        await message.reply("Не удалось обработать вложение.")
+        return None
+    bytes_saved = sum(saved for _, saved in downloaded)
+    if bytes_saved > 0:
+        logging.info("[%s] Image preprocessing saved %s bytes before base64 encoding", req_id, bytes_saved)
+    return [att for att, _ in downloaded]
+
+async def drop_claim(claim: asyncio.Task, chat_id: int, message_id: int):
+    # Undo a ledger claim for a request that stopped before reaching the model,
+    # so a redelivery or a re-run after an edit is not skipped as a duplicate.
+    if await claim:
+        await update_ledger.release(chat_id, message_id)
+
+def close_attachments(attachments: list[dict]):
+    for att in attachments:
+        if "source" in att:
+            att["source"].close()
+
+def reply_text_of(reply_data: dict) -> str:
+    reply_text = reply_data.get("text", "")
+    if reply_text.startswith("Generating..."):
+        reply_text = reply_text[len("Generating..."):].lstrip()
+    return clean_response_text(reply_text)
+
+async def charge_reply(message: Message, model: str, reply_data: dict, req_id: str) -> str:
+    query_id = reply_data.get("id")
+    created_time = reply_data.get("created")
+    key = reply_data.get("key")
+    usage = reply_data.get("usage") or {}
+    points_cost = cost_model.estimate(model, usage)
+    cost_prefix = "≈"
+    if points_cost is None:
+        points_cost = await calibrate_cost(query_id, created_time, model, key, usage, request_id=req_id)
+        cost_prefix = ""
+    elif cost_model.needs_recalibration(model):
+        inflight.spawn(calibrate_cost(query_id, created_time, model, key, usage, request_id=req_id))
+
+    if points_cost is None:
+        return "**Стоимость ?**"
+    balance_cache.charge(points_cost, key)
+    budgets.charge(message.from_user.id, message.chat.id, points_cost)
+    handlers_shared.publish({"type": "budget_charge", "user_id": message.from_user.id, "chat_id": message.chat.id, "points": points_cost})
+    await asyncio.to_thread(db.record_usage, message.from_user.username, message.chat.id, model, points_cost)
+    return f"**Стоимость {cost_prefix}{points_cost} очков**"
+
+def context_after_reply(old_messages: list, latest_messages: list, content: str, reply: str) -> tuple[list, str, str]:
+    final_user_content = content
+    final_assistant_content = reply
+
+    if latest_messages != old_messages:
+        final_user_content += "\n\n[THIS QUERY HAS BEEN SIMULTANEOUS, CHRONOLOGICAL ERRORS POSSIBLE]"
+        final_assistant_content += "\n\n[THIS RESPONSE HAS BEEN SIMULTANEOUS, CHRONOLOGICAL ERRORS POSSIBLE]"
+
+    messages = list(latest_messages)
+    messages.append({"role": "user", "content": final_user_content})
+    messages.append({"role": "assistant", "content": final_assistant_content})
+
+    trimmed_clean = []
+    for m in messages[-CONTEXT_MAX_MESSAGES:]:
+        if isinstance(m, dict):
+            m_copy = m.copy()
+            m_copy.pop("attachments", None)
+            trimmed_clean.append(m_copy)
+        else:
+            trimmed_clean.append(m)
+    return trimmed_clean, final_user_content, final_assistant_content
+
+async def process_message(message: Message, req_id: str, album: list | None = None):
     text = message.text or message.caption or ""
+    fanout_trig, fanout_content = extract_fanout_text(text)
+    if fanout_trig and FANOUT_MODELS:
+        await process_fanout(message, fanout_content, req_id, album)
+        return
     trig, model, content = extract_trigger_and_text(text)
     if not trig or not model:
         return
+    started = time.perf_counter()
+    chat_id = message.chat.id
     allowed, _ = await ensure_whitelisted_or_prompt(message)
     if not allowed:
         return
-    chat_id = message.chat.id
     username = message.from_user.username or message.from_user.first_name or "Unknown"
     
-    logging.info(f"[{req_id}] Handling message from {username} (chat {chat_id}), model: {model}")
+    logging.info("[%s] Handling message from %s (chat %s), model: %s", req_id, username, chat_id, model)
 
     if is_clear_command(content):
+        model_requests.cancel_model(chat_id, model, "context cleared")
         await asyncio.to_thread(db.clear_context, chat_id, model)
         await message.reply(f"Контекст очищен для {model}")
         return
 
     if handlers_shared.economy_mode and model not in ECONOMY_BOTS:
-        allowed_triggers = []
-        for triggers, m in BOT_CONFIGS.items():
-            if m in ECONOMY_BOTS:
-                allowed_triggers.extend(triggers)
-        allowed_triggers = list(dict.fromkeys(allowed_triggers))
-        if allowed_triggers:
-            await message.reply("Сейчас включен режим экономии очков. Доступны боты: " + ", ".join(allowed_triggers) + ". Пожалуйста, используйте один из них.")
-        else:
-            await message.reply("Сейчас включен режим экономии очков. Пожалуйста, используйте доступные боты.")
+        await reply_economy_notice(message)
         return
 
-    if not content and not (message.photo or message.video or message.document):
-        await message.reply("Введите запрос после триггера или прикрепите файл.")
+    if not await check_request_allowed(message, content):
         return
 
-    attachments = []
-    attachment_source = None
-    if message.photo:
-        attachment_source = message.photo[-1]
-    elif message.video:
-        attachment_source = message.video
-    elif message.document:
-        attachment_source = message.document
-
-    if attachment_source:
-        try:
-            try:
-                logging.info(f"[{req_id}] Sending ChatAction.UPLOAD_DOCUMENT...")
-                await message.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
-            except Exception as e:
-                logging.warning(f"[{req_id}] Failed to send ChatAction.UPLOAD_DOCUMENT: {e}")
-
-            logging.info(f"[{req_id}] Downloading file from Telegram: {attachment_source.file_id}")
-            file_info = await message.bot.get_file(attachment_source.file_id)
-            file_content = io.BytesIO()
-            await message.bot.download_file(file_info.file_path, file_content)
-            logging.info(f"[{req_id}] File downloaded successfully.")
-            file_content.seek(0)
-            file_bytes = file_content.read()
-            
-            file_name = getattr(attachment_source, 'file_name', None) or 'attachment.dat'
-            
-            mime_type = "application/octet-stream"
-            if hasattr(attachment_source, 'mime_type') and attachment_source.mime_type:
-                mime_type = attachment_source.mime_type
-            else:
-                guessed, _ = mimetypes.guess_type(file_name)
-                if guessed:
-                    mime_type = guessed
-                elif message.photo:
-                    mime_type = "image/jpeg"
-                elif message.video:
-                    mime_type = "video/mp4"
-
-            b64_data = base64.b64encode(file_bytes).decode('utf-8')
-            
-            attachments.append({
-                "filename": file_name,
-                "content_type": mime_type,
-                "data_base64": b64_data
-            })
+    request = model_requests.register(chat_id, message.message_id, model, album)
+    claim = asyncio.create_task(update_ledger.claim(chat_id, message.message_id, request_id=req_id))
+    # The database connection is serialized, so the context load only overlaps
+    # with work that does not touch it: the attachment download.
+    context_load = asyncio.create_task(asyncio.to_thread(db.get_context, chat_id, model))
 
-        except Exception as e:
-            logging.exception(f"[{req_id}] Не удалось обработать вложение", exc_info=e)
-            await message.reply("Не удалось обработать вложение.")
+    attachments = None
+    claimed = False
+    reply_data = {}
+    try:
+        download_started = time.perf_counter()
+        attachments = await collect_attachments(message, model, req_id, request)
+        if attachments is None:
             return
+        download_ms = (time.perf_counter() - download_started) * 1000
 
-    old_messages = await asyncio.to_thread(db.get_context, chat_id, model)
-    new_messages = list(old_messages)
-    
-    user_message = {"role": "user", "content": content}
-    if attachments:
-        user_message["attachments"] = attachments
-    
-    new_messages.append(user_message)
+        context_wait = time.perf_counter()
+        old_messages = await context_load
+        context_wait_ms = (time.perf_counter() - context_wait) * 1000
+        new_messages = list(old_messages)
 
-    context_to_send = new_messages[-CONTEXT_MAX_MESSAGES:]
-    
-    reply_data = {}
-    try:
-        try:
-            logging.info(f"[{req_id}] Sending ChatAction.TYPING...")
-            await message.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        except Exception as e:
-            logging.warning(f"[{req_id}] Failed to send ChatAction.TYPING: {e}")
-        
-        reply_data = await ai.chat(model, context_to_send, request_id=req_id)
+        user_message = {"role": "user", "content": content}
+        if attachments:
+            user_message["attachments"] = attachments
+
+        new_messages.append(user_message)
+
+        context_to_send = new_messages[-CONTEXT_MAX_MESSAGES:]
+
+        claimed = await claim
+        if not claimed:
+            return
+        logging.info("[%s] Calling %s after %.0f ms of preparation (attachments %.0f ms, then context wait %.0f ms)", req_id, model, (time.perf_counter() - started) * 1000, download_ms, context_wait_ms)
+        async with chat_action(message, ChatAction.TYPING, req_id):
+            reply_data = await ai.chat(model, context_to_send, request_id=req_id)
+        request.committed = True
     except Exception as e:
-        logging.exception(f"[{req_id}] Ошибка при обращении к модели %s", model, exc_info=e)
+        logging.exception("[%s] Ошибка при обращении к модели %s", req_id, model, exc_info=e)
         await message.reply("Ошибка на стороне сервиса, попробуйте позже")
         return
+    finally:
+        if attachments:
+            close_attachments(attachments)
+        if not claimed:
+            context_load.cancel()
+            await drop_claim(claim, chat_id, message.message_id)
 
-    reply_text = reply_data.get("text", "")
-    if reply_text.startswith("Generating..."):
-        reply_text = reply_text[len("Generating..."):].lstrip()
-
-    cleaned_reply = post_process_response_text(reply_text)
-    normalized_reply = markdown_normalize(cleaned_reply)
+    normalized_reply = reply_text_of(reply_data)
 
-    query_id = reply_data.get("id")
-    created_time = reply_data.get("created")
-    points_cost = await get_points_cost(query_id, created_time, model, request_id=req_id)
-    
-    decorated_reply = normalized_reply
-    if points_cost is not None:
-        user_username = message.from_user.username
-        if user_username:
-            await asyncio.to_thread(db.increment_usage_username, user_username, points_cost)
-        decorated_reply = normalized_reply + f"\n\n**Стоимость {points_cost} очков**"
-    else:
-        decorated_reply = normalized_reply + "\n\n**Стоимость ?**"
+    cost_line = await charge_reply(message, model, reply_data, req_id)
+    decorated_reply = normalized_reply + "\n\n" + cost_line
     
     latest_messages = await asyncio.to_thread(db.get_context, chat_id, model)
-    
-    final_user_content = content
-    final_assistant_content = normalized_reply
+    trimmed_clean, final_user_content, final_assistant_content = context_after_reply(old_messages, latest_messages, content, normalized_reply)
 
-    if latest_messages != old_messages:
-        final_user_content += "\n\n[THIS QUERY HAS BEEN SIMULTANEOUS, CHRONOLOGICAL ERRORS POSSIBLE]"
-        final_assistant_content += "\n\n[THIS RESPONSE HAS BEEN SIMULTANEOUS, CHRONOLOGICAL ERRORS POSSIBLE]"
-    
-    user_msg_to_save = {"role": "user", "content": final_user_content}
-    
-    assistant_msg_to_save = {"role": "assistant", "content": final_assistant_content}
-    
-    latest_messages.append(user_msg_to_save)
-    latest_messages.append(assistant_msg_to_save)
-    
-    trimmed = latest_messages[-CONTEXT_MAX_MESSAGES:]
-    
-    trimmed_clean = []
-    for m in trimmed:
-        if isinstance(m, dict):
-            m_copy = m.copy()
-            m_copy.pop("attachments", None)
-            trimmed_clean.append(m_copy)
-        else:
-            trimmed_clean.append(m)
-            
-    await asyncio.to_thread(db.set_context, chat_id, model, trimmed_clean)
+    if request.reason is None:
+        await asyncio.to_thread(db.set_context, chat_id, model, trimmed_clean)
+    else:
+        logging.info("[%s] Not saving context, request was cancelled: %s", req_id, request.reason)
     await asyncio.to_thread(db.append_log, chat_id, model, username, "user", final_user_content)
     await asyncio.to_thread(db.append_log, chat_id, model, username, "assistant", final_assistant_content)
     
-    await safe_reply_markdown(message, decorated_reply, request_id=req_id)
\ No newline at end of file
+    await safe_reply_markdown(message, decorated_reply, request_id=req_id)
+    await send_image_outputs(message, reply_data.get("attachments") or [], request_id=req_id)
+
+async def fanout_one(message: Message, model: str, content: str, attachments: list[dict], old_messages: list, req_id: str, album: list | None = None) -> tuple[str, str] | None:
+    task = asyncio.current_task()
+    request = model_requests.register(message.chat.id, message.message_id, model, album)
+    try:
+        user_message = {"role": "user", "content": content}
+        if attachments:
+            user_message["attachments"] = attachments
+        context_to_send = (list(old_messages) + [user_message])[-CONTEXT_MAX_MESSAGES:]
+        try:
+            reply_data = await asyncio.wait_for(ai.chat(model, context_to_send, request_id=req_id), FANOUT_TIMEOUT)
+            request.committed = True
+        except asyncio.CancelledError:
+            if request.reason is None:
+                raise
+            task.uncancel()
+            logging.info("[%s] Request cancelled: %s", req_id, request.reason)
+            return None
+        except asyncio.TimeoutError:
+            logging.warning("[%s] %s did not answer within %ss", req_id, model, FANOUT_TIMEOUT)
+            await message.reply(f"{model}: нет ответа за {int(FANOUT_TIMEOUT)} с.", parse_mode=None)
+            return None
+        except Exception as e:
+            logging.exception("[%s] Ошибка при обращении к модели %s", req_id, model, exc_info=e)
+            await message.reply(f"{model}: ошибка на стороне сервиса, попробуйте позже", parse_mode=None)
+            return None
+
+        normalized_reply = reply_text_of(reply_data)
+        cost_line = await charge_reply(message, model, reply_data, req_id)
+        await safe_reply_markdown(message, f"**{model}**\n\n{normalized_reply}\n\n{cost_line}", request_id=req_id)
+        await send_image_outputs(message, reply_data.get("attachments") or [], request_id=req_id)
+        if request.reason is not None:
+            logging.info("[%s] Not saving context, request was cancelled: %s", req_id, request.reason)
+            return None
+        return content, normalized_reply
+    finally:
+        model_requests.discard(task)
+
+async def process_fanout(message: Message, content: str, req_id: str, album: list | None = None):
+    started = time.perf_counter()
+    chat_id = message.chat.id
+    models = list(FANOUT_MODELS)
+    allowed, _ = await ensure_whitelisted_or_prompt(message)
+    if not allowed:
+        return
+    username = message.from_user.username or message.from_user.first_name or "Unknown"
+
+    logging.info("[%s] Handling fan-out from %s (chat %s), models: %s", req_id, username, chat_id, ", ".join(models))
+
+    if is_clear_command(content):
+        for model in models:
+            model_requests.cancel_model(chat_id, model, "context cleared")
+            await asyncio.to_thread(db.clear_context, chat_id, model)
+        await message.reply("Контекст очищен для " + ", ".join(models), parse_mode=None)
+        return
+
+    if handlers_shared.economy_mode:
+        models = [m for m in models if m in ECONOMY_BOTS]
+        if not models:
+            await reply_economy_notice(message)
+            return
+
+    if not await check_request_allowed(message, content):
+        return
+
+    # Stands in for the per-model requests until they start, so an edit that
+    # arrives while attachments are downloading still cancels and re-runs.
+    placeholder = model_requests.register(chat_id, message.message_id, FANOUT_REQUEST, album)
+    claim = asyncio.create_task(update_ledger.claim(chat_id, message.message_id, request_id=req_id))
+    context_load = asyncio.create_task(asyncio.to_thread(db.get_contexts, chat_id, models))
+    attachments = None
+    claimed = False
+    try:
+        attachments = await collect_attachments(message, models[0], req_id, placeholder)
+        if attachments is None:
+            return
+        old_contexts = await context_load
+        if handlers_shared.economy_mode:
+            models = [m for m in models if m in ECONOMY_BOTS]
+            if not models:
+                await reply_economy_notice(message)
+                return
+        claimed = await claim
+        if not claimed:
+            return
+        model_requests.discard(asyncio.current_task())
+        logging.info("[%s] Calling %s models after %.0f ms of preparation", req_id, len(models), (time.perf_counter() - started) * 1000)
+        async with chat_action(message, ChatAction.TYPING, req_id):
+            results = await asyncio.gather(*(
+                fanout_one(message, model, content, attachments, old_contexts.get(model, []), f"{req_id}:{model}", placeholder.album)
+                for model in models
+            ), return_exceptions=True)
+    finally:
+        if attachments:
+            close_attachments(attachments)
+        if not claimed:
+            context_load.cancel()
+            await drop_claim(claim, chat_id, message.message_id)
+
+    exchanges = {}
+    for model, result in zip(models, results):
+        if isinstance(result, BaseException):
+            logging.error("[%s] Fan-out to %s failed: %s", req_id, model, result)
+        elif result:
+            exchanges[model] = result
+    if not exchanges:
+        return
+    latest_contexts = await asyncio.to_thread(db.get_contexts, chat_id, list(exchanges))
+    contexts = {}
+    logs = []
+    for model, (user_content, reply) in exchanges.items():
+        saved, final_user_content, final_assistant_content = context_after_reply(old_contexts.get(model, []), latest_contexts.get(model, []), user_content, reply)
+        contexts[model] = saved
+        logs.append((model, username, "user", final_user_content))
+        logs.append((model, username, "assistant", final_assistant_content))
+    await asyncio.to_thread(db.save_exchanges, chat_id, contexts, logs)
+
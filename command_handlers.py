@@ -1,96 +1,102 @@
 import asyncio
 import re
-import aiohttp
 import logging
-from datetime import timedelta
+import os
+import secrets
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command, CommandObject
-from config import POE_API_KEY, ADMIN_CHAT_ID, BOT_CONFIGS, ECONOMY_BOTS, ADMIN_USERNAME
+from config import ADMIN_CHAT_ID, BOT_CONFIGS, ECONOMY_BOTS, ADMIN_USERNAME, FANOUT_MODELS
 from handlers_shared import db
 import handlers_shared
-from chat_handlers import safe_reply_markdown, ensure_whitelisted_or_prompt
+from chat_handlers import safe_reply_markdown, ensure_whitelisted_or_prompt, build_trigger_map, cancel_non_economy_requests
+from profiler import profiler
+from markdown_v2 import markdown_stats
+from memory_diagnostics import memory_diagnostics
+from poe_balance import balance_cache
+from key_pool import key_pool
+from budgets import budgets, UNLIMITED
+from log_export import export_logs, export_parts
+from utils import chunk_text
 
 router = Router()
 
 def is_admin_user(user) -> bool:
     return bool(user and user.username == ADMIN_USERNAME)
 
-async def fetch_current_balance(request_id: str = "N/A"):
-    headers = {
-        "Authorization": f"Bearer {POE_API_KEY}",
-        "Accept-Encoding": "gzip, deflate"
-    }
-    try:
-        logging.info(f"[{request_id}] Requesting current balance from Poe API (async)...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.poe.com/usage/current_balance",
-                headers=headers,
-                timeout=10
-            ) as resp:
-                logging.info(f"[{request_id}] Current balance response status: {resp.status}")
-                if resp.status != 200:
-                    return None
-                data = await resp.json()
-                bal = data.get("current_point_balance")
-                return int(bal) if bal is not None else None
-    except Exception as e:
-        logging.error(f"[{request_id}] Error fetching current balance: {e}")
-        return None
-
 @router.message(F.text.casefold() == "ии")
 async def handle_bots_list_command_text(message: Message):
     await handle_bots_list_command(message)
 
-async def handle_bots_list_command(message: Message):
-    req_id = f"cmd_list_{message.message_id}"
-    allowed, _ = await ensure_whitelisted_or_prompt(message)
-    if not allowed:
-        return
+def build_bots_catalog(economy: bool) -> str:
     sorted_bots = sorted(BOT_CONFIGS.items(), key=lambda item: item[1])
-
-    if handlers_shared.economy_mode:
+    if economy:
         reply_lines = ["*Доступные боты и их триггеры (включен режим экономии — доступны только экономичные боты для сохранения очков):*"]
-        for triggers, model in sorted_bots:
-            if model in ECONOMY_BOTS:
-                safe_model = re.sub(r'([_*[]()~`>#+\-=|{}.!])', r'\\\1', model)
-                trigger_str = ", ".join(f"`{t}`" for t in triggers)
-                reply_lines.append(f"• *{safe_model}*: {trigger_str}")
     else:
         reply_lines = ["*Доступные боты и их триггеры:*"]
-        for triggers, model in sorted_bots:
-            safe_model = re.sub(r'([_*[]()~`>#+\-=|{}.!])', r'\\\1', model)
-            trigger_str = ", ".join(f"`{t}`" for t in triggers)
-            reply_lines.append(f"• *{safe_model}*: {trigger_str}")
+    for triggers, model in sorted_bots:
+        if economy and model not in ECONOMY_BOTS:
+            continue
+        safe_model = re.sub(r'([_*[]()~`>#+\-=|{}.!])', r'\\\1', model)
+        trigger_str = ", ".join(f"`{t}`" for t in triggers)
+        reply_lines.append(f"• *{safe_model}*: {trigger_str}")
+    return "\n".join(reply_lines)
 
-    balance = await fetch_current_balance(req_id)
-    reply_lines.append("")
+BOTS_CATALOG = {economy: build_bots_catalog(economy) for economy in (False, True)}
+
+COMMANDS_HELP = "\n".join([
+    "*Команды для всех пользователей:*",
+    "• `/start` — краткая справка и инструкция.",
+    "• `/clear <триггер>` — сбросить контекст выбранного бота.",
+    "• `/collapsible_quote_on` — включить режим разворачиваемых цитат в этом чате (ответы длиннее 500 символов будут отображаться в разворачиваемой цитате).",
+    "• `/collapsible_quote_off` — выключить режим разворачиваемых цитат в этом чате.",
+    "• Сообщение «ИИ» — показать список ботов, команд и текущий баланс.",
+] + ([
+    "• `/all <запрос>` или `все: <запрос>` — отправить запрос сразу нескольким ботам (" + ", ".join(FANOUT_MODELS) + ").",
+] if FANOUT_MODELS else []))
+
+async def handle_bots_list_command(message: Message):
+    req_id = f"cmd_list_{message.message_id}"
+    allowed, _ = await ensure_whitelisted_or_prompt(message)
+    if not allowed:
+        return
+    balance = await balance_cache.get(req_id)
     if balance is not None:
-        reply_lines.append(f"Текущий баланс: {balance} очков")
+        balance_line = f"Текущий баланс: {balance} очков"
     else:
-        reply_lines.append("Не удалось получить текущий баланс очков.")
-    reply_lines.append("")
-    reply_lines.append("*Команды для всех пользователей:*")
-    reply_lines.append("• `/start` — краткая справка и инструкция.")
-    reply_lines.append("• `/clear <триггер>` — сбросить контекст выбранного бота.")
-    reply_lines.append("• `/collapsible_quote_on` — включить режим разворачиваемых цитат в этом чате (ответы длиннее 500 символов будут отображаться в разворачиваемой цитате).")
-    reply_lines.append("• `/collapsible_quote_off` — выключить режим разворачиваемых цитат в этом чате.")
-    reply_lines.append("• Сообщение «ИИ» — показать список ботов, команд и текущий баланс.")
-    reply_text = "\n".join(reply_lines)
+        balance_line = "Не удалось получить текущий баланс очков."
+    reply_text = "\n".join([BOTS_CATALOG[handlers_shared.economy_mode], "", balance_line, "", COMMANDS_HELP])
     await safe_reply_markdown(message, reply_text, request_id=req_id)
 
+LEADERBOARD_WINDOWS = {
+    "day": (24, "за сутки"), "день": (24, "за сутки"),
+    "week": (24 * 7, "за неделю"), "неделя": (24 * 7, "за неделю"),
+    "month": (24 * 30, "за месяц"), "месяц": (24 * 30, "за месяц"),
+    "all": (None, "за всё время"), "всё": (None, "за всё время"), "все": (None, "за всё время"),
+}
+
 @router.message(Command("leaderboard"))
-async def handle_leaderboard_command(message: Message):
+async def handle_leaderboard_command(message: Message, command: CommandObject):
     req_id = f"cmd_lead_{message.message_id}"
     if not is_admin_user(message.from_user):
         return
-    rows = await asyncio.to_thread(db.list_usage_leaderboard_usernames)
+    window = (command.args or "").strip().lower()
+    if window and window not in LEADERBOARD_WINDOWS:
+        await message.reply("Использование: /leaderboard [day|week|month|all]", parse_mode=None)
+        return
+    if window:
+        hours, title = LEADERBOARD_WINDOWS[window]
+        rows = await asyncio.to_thread(db.list_usage_rollup_leaderboard, hours)
+    else:
+        title = None
+        rows = await asyncio.to_thread(db.list_usage_leaderboard_usernames)
     if not rows:
         await message.reply("Нет данных по использованию.")
         return
-    lines = ["Лидерборд по использованию очков:"]
+    lines = [f"Лидерборд по использованию очков {title}:" if title else "Лидерборд по использованию очков:"]
     for idx, r in enumerate(rows, start=1):
         uname = r.get("username") or "нет данных"
         lines.append(f"{idx}. @{uname} — {r['total_points']} очков")
@@ -104,6 +110,197 @@ async def handle_leaderboard_reset_command(message: Message):
     await asyncio.to_thread(db.reset_usage_leaderboard_usernames)
     await message.reply("Лидерборд сброшен.")
 
+@router.message(Command("slow_requests"))
+async def handle_slow_requests_command(message: Message):
+    if not is_admin_user(message.from_user):
+        return
+    if not profiler.enabled:
+        await message.reply("Профилирование выключено, включите PROFILE_ENABLED=1.", parse_mode=None)
+        return
+    entries = profiler.recent_slow()
+    if not entries:
+        await message.reply("Медленных запросов не было.", parse_mode=None)
+        return
+    lines = ["Последние медленные запросы:"]
+    for e in entries:
+        lines.append(f"{e['request_id']} {e['name']} — {e['elapsed_ms']} мс")
+        for frame, count in e["top_frames"]:
+            lines.append(f"    {count}× {frame}")
+    await message.reply("\n".join(lines), parse_mode=None)
+
+@router.message(Command("markdown_stats"))
+async def handle_markdown_stats_command(message: Message):
+    if not is_admin_user(message.from_user):
+        return
+    total = sum(markdown_stats[k] for k in ("valid", "repaired", "plain"))
+    lines = [
+        f"Частей ответа отправлено: {total}",
+        f"Корректная разметка: {markdown_stats['valid']}",
+        f"Исправлено локально: {markdown_stats['repaired']}",
+        f"Отправлено без разметки: {markdown_stats['plain']}",
+        f"Отклонено Telegram: {markdown_stats['rejected']}",
+    ]
+    await message.reply("\n".join(lines), parse_mode=None)
+
+@router.message(Command("debug_mem"))
+async def handle_debug_mem_command(message: Message, command: CommandObject):
+    if not is_admin_user(message.from_user):
+        return
+    arg = (command.args or "").strip()
+    if arg.lower() == "stop":
+        stopped = memory_diagnostics.stop()
+        await message.reply("Трассировка памяти выключена." if stopped else "Трассировка памяти не была включена.", parse_mode=None)
+        return
+    limit = int(arg) if arg.isdigit() else 10
+    report = await memory_diagnostics.report(min(limit, 50))
+    for part in chunk_text(report):
+        await message.reply(part, parse_mode=None)
+
+@router.message(Command("keys"))
+async def handle_keys_command(message: Message):
+    if not is_admin_user(message.from_user):
+        return
+    lines = ["Ключи Poe API:"]
+    for k in key_pool.keys:
+        balance = k.balance if k.balance is not None else "?"
+        status = "исчерпан" if k.exhausted else "активен"
+        lines.append(f"{k.label} | баланс: {balance} | потрачено: {k.points_spent} | запросов: {k.requests} | 429 за 10 мин: {k.recent_rate_limits()} | {status}")
+    await message.reply("\n".join(lines), parse_mode=None)
+
+@router.message(Command("budget"))
+async def handle_budget_command(message: Message, command: CommandObject):
+    if not is_admin_user(message.from_user):
+        return
+    args = (command.args or "").split()
+    usage = "Использование: /budget <user|chat> <ID> [очки|off|default]"
+    if len(args) < 2 or args[0] not in ("user", "chat"):
+        await message.reply(usage, parse_mode=None)
+        return
+    scope = args[0]
+    try:
+        entity_id = int(args[1])
+    except ValueError:
+        await message.reply("Неверный ID.", parse_mode=None)
+        return
+    if len(args) > 2:
+        value = args[2].lower()
+        if value == "off":
+            capacity = UNLIMITED
+        elif value == "default":
+            capacity = None
+        elif value.isdigit():
+            capacity = int(value)
+        else:
+            await message.reply(usage, parse_mode=None)
+            return
+        budgets.set_override(scope, entity_id, capacity)
+        handlers_shared.publish({"type": "budget_override", "scope": scope, "entity_id": entity_id, "capacity": capacity})
+        await budgets.checkpoint()
+    bucket = budgets.bucket(scope, entity_id)
+    capacity = budgets.capacity(scope, bucket)
+    limit = "без ограничений" if capacity == UNLIMITED else f"{capacity} очков"
+    await message.reply(f"Бюджет {scope} {entity_id}: {limit}, доступно сейчас {int(bucket.tokens)}.", parse_mode=None)
+
+SEARCH_PAGE_SIZE = 10
+search_sessions = OrderedDict()
+
+def parse_search_args(args: str):
+    filters = {"chat_id": None, "bot_key": None, "since": None, "until": None}
+    words = []
+    tmap = build_trigger_map()
+    for word in args.split():
+        name, _, value = word.partition(":")
+        if value and name == "chat":
+            filters["chat_id"] = int(value)
+        elif value and name == "bot":
+            filters["bot_key"] = tmap.get(value.lower(), value)
+        elif value and name == "from":
+            filters["since"] = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        elif value and name == "to":
+            filters["until"] = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+        else:
+            words.append(word)
+    return " ".join(words), filters
+
+async def send_search_page(message: Message, token: str):
+    session = search_sessions[token]
+    rows = await asyncio.to_thread(
+        db.search_logs, session["query"], cursor=session["cursor"], limit=SEARCH_PAGE_SIZE, **session["filters"]
+    )
+    if not rows:
+        await message.answer("Ничего не найдено." if session["cursor"] is None else "Больше результатов нет.", parse_mode=None)
+        search_sessions.pop(token, None)
+        return
+    lines = []
+    for r in rows:
+        when = r["created_at"].strftime("%Y-%m-%d %H:%M")
+        snippet = " ".join((r["snippet"] or "").split())
+        lines.append(f"{when} | {r['chat_id']} | {r['bot_key']} | @{r['username'] or '?'} ({r['role']}):\n{snippet}")
+    last = rows[-1]
+    session["cursor"] = (last["created_at"], last["id"])
+    keyboard = None
+    if len(rows) == SEARCH_PAGE_SIZE:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Дальше", callback_data=f"search_next:{token}")]
+        ])
+    await message.answer("\n\n".join(lines), parse_mode=None, reply_markup=keyboard)
+
+@router.message(Command("search"))
+async def handle_search_command(message: Message, command: CommandObject):
+    if not is_admin_user(message.from_user):
+        return
+    try:
+        query, filters = parse_search_args(command.args or "")
+    except ValueError:
+        query, filters = "", None
+    if not query or filters is None:
+        await message.reply("Использование: /search <запрос> [chat:<ID>] [bot:<триггер>] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]", parse_mode=None)
+        return
+    token = secrets.token_hex(4)
+    search_sessions[token] = {"query": query, "filters": filters, "cursor": None}
+    while len(search_sessions) > 100:
+        search_sessions.popitem(last=False)
+    await send_search_page(message, token)
+
+@router.callback_query(F.data.startswith("search_next:"))
+async def handle_search_next_callback(callback: CallbackQuery):
+    await callback.answer()
+    if not is_admin_user(callback.from_user):
+        return
+    token = (callback.data or "").split(":", 1)[1]
+    if token not in search_sessions:
+        await callback.message.answer("Поиск устарел, повторите команду.", parse_mode=None)
+        return
+    await send_search_page(callback.message, token)
+
+@router.message(Command("export_logs"))
+async def handle_export_logs_command(message: Message, command: CommandObject):
+    if not is_admin_user(message.from_user):
+        return
+    try:
+        rest, filters = parse_search_args(command.args or "")
+    except ValueError:
+        rest, filters = "?", None
+    if rest:
+        await message.reply("Использование: /export_logs [chat:<ID>] [bot:<триггер>] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]", parse_mode=None)
+        return
+    await message.reply("Готовлю выгрузку логов...", parse_mode=None)
+    try:
+        path = await asyncio.to_thread(export_logs, **filters)
+    except Exception as e:
+        logging.error("Failed to export chat logs: %s", e)
+        await message.reply("Не удалось выгрузить логи.", parse_mode=None)
+        return
+    try:
+        filename = "chat_logs_" + datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S") + ".csv.gz"
+        for part in export_parts(path, filename):
+            await message.reply_document(part)
+    except Exception as e:
+        logging.error("Failed to send chat logs export: %s", e)
+        await message.reply("Не удалось отправить выгрузку логов.", parse_mode=None)
+    finally:
+        os.remove(path)
+
 @router.callback_query(F.data.startswith("whitelist_request:"))
 async def handle_whitelist_request_callback(callback: CallbackQuery):
     await callback.answer()
@@ -129,10 +326,10 @@ async def handle_whitelist_request_callback(callback: CallbackQuery):
         [InlineKeyboardButton(text="Добавить в белый список.", callback_data=f"whitelist_approve:{entity_id}")]
     ])
     try:
-        logging.info(f"Sending whitelist request to admin chat {ADMIN_CHAT_ID}")
+        logging.info("Sending whitelist request to admin chat %s", ADMIN_CHAT_ID)
         await callback.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_text, reply_markup=keyboard)
     except Exception as e:
-        logging.error(f"Failed to send whitelist request to admin: {e}")
+        logging.error("Failed to send whitelist request to admin: %s", e)
         pass
 
 @router.callback_query(F.data.startswith("whitelist_approve:"))
@@ -151,10 +348,10 @@ async def handle_whitelist_approve_callback(callback: CallbackQuery):
     except Exception:
         pass
     try:
-        logging.info(f"Sending approval notification to {entity_id}")
+        logging.info("Sending approval notification to %s", entity_id)
         await callback.bot.send_message(chat_id=entity_id, text="Вы добавлены в белый список и можете пользоваться ботом.")
     except Exception as e:
-        logging.error(f"Failed to send approval notification: {e}")
+        logging.error("Failed to send approval notification: %s", e)
         pass
 
 @router.message(Command("whitelist_list"))
@@ -203,6 +400,10 @@ async def handle_economy_on_command(message: Message):
         return
     handlers_shared.economy_mode = True
     await asyncio.to_thread(db.set_economy_mode, True)
+    handlers_shared.publish({"type": "economy", "enabled": True})
+    cancelled = cancel_non_economy_requests()
+    if cancelled:
+        logging.info("Economy mode cancelled %s in-flight requests", cancelled)
     allowed_triggers = []
     for triggers, model in BOT_CONFIGS.items():
         if model in ECONOMY_BOTS:
@@ -219,6 +420,7 @@ async def handle_economy_off_command(message: Message):
         return
     handlers_shared.economy_mode = False
     await asyncio.to_thread(db.set_economy_mode, False)
+    handlers_shared.publish({"type": "economy", "enabled": False})
     await message.reply("Режим экономии выключен. Доступны все боты.")
 
 @router.message(Command("collapsible_quote_on"))
@@ -4,6 +4,9 @@ load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 POE_API_KEY = os.getenv("POE_API_KEY")
+POE_API_KEYS = [k.strip() for k in (os.getenv("POE_API_KEYS") or POE_API_KEY or "").split(",") if k.strip()]
+POE_KEY_MIN_BALANCE = int(os.getenv("POE_KEY_MIN_BALANCE", "0"))
+POE_KEY_COOLDOWN = float(os.getenv("POE_KEY_COOLDOWN", "30"))
 POE_BASE_URL = os.getenv("POE_BASE_URL", "https://api.poe.com/v1")
 
 DB_CONFIG = {
@@ -43,4 +46,67 @@ ECONOMY_BOTS = {"Gemini-3-Flash"}
 
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "")
-UPLOAD_PROXY_URL = os.getenv("UPLOAD_PROXY_URL")
\ No newline at end of file
+UPLOAD_PROXY_URL = os.getenv("UPLOAD_PROXY_URL")
+
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "60"))
+BALANCE_REFRESH_INTERVAL = float(os.getenv("BALANCE_REFRESH_INTERVAL", "300"))
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_SLOW_MS = int(os.getenv("PROFILE_SLOW_MS", "15000"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "20"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+LOG_PARTITION_MONTHS_AHEAD = int(os.getenv("LOG_PARTITION_MONTHS_AHEAD", "2"))
+LOG_RETENTION_MONTHS = int(os.getenv("LOG_RETENTION_MONTHS", "0"))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "log_archive")
+LOG_MAINTENANCE_INTERVAL = float(os.getenv("LOG_MAINTENANCE_INTERVAL", "86400"))
+
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "120"))
+
+COST_MODEL_MIN_SAMPLES = int(os.getenv("COST_MODEL_MIN_SAMPLES", "5"))
+COST_MODEL_DECAY = float(os.getenv("COST_MODEL_DECAY", "0.98"))
+COST_RECALIBRATE_RATE = float(os.getenv("COST_RECALIBRATE_RATE", "0.1"))
+
+ALBUM_COLLECT_DELAY = float(os.getenv("ALBUM_COLLECT_DELAY", "1.0"))
+
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1568"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_MODEL_TARGETS = {
+    "Gemini-2.0-Flash-Exp": (2048, 90),
+    "Gemini-2.5-Flash-Image": (2048, 90),
+}
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_OUTPUT_MAX_BYTES = int(os.getenv("IMAGE_OUTPUT_MAX_BYTES", "20971520"))
+
+DOC_TEXT_MAX_CHARS = int(os.getenv("DOC_TEXT_MAX_CHARS", "200000"))
+DOC_TEXT_CACHE_SIZE = int(os.getenv("DOC_TEXT_CACHE_SIZE", "256"))
+DOC_WORKERS = int(os.getenv("DOC_WORKERS", "2"))
+
+USER_BUDGET_POINTS = int(os.getenv("USER_BUDGET_POINTS", "0"))
+USER_BUDGET_PERIOD = float(os.getenv("USER_BUDGET_PERIOD", "86400"))
+CHAT_BUDGET_POINTS = int(os.getenv("CHAT_BUDGET_POINTS", "0"))
+CHAT_BUDGET_PERIOD = float(os.getenv("CHAT_BUDGET_PERIOD", "86400"))
+BUDGET_CHECKPOINT_INTERVAL = float(os.getenv("BUDGET_CHECKPOINT_INTERVAL", "60"))
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_REPORT_INTERVAL = float(os.getenv("WORKER_REPORT_INTERVAL", "60"))
+
+UPDATE_LEDGER_TTL = float(os.getenv("UPDATE_LEDGER_TTL", "172800"))
+UPDATE_LEDGER_HOT_SIZE = int(os.getenv("UPDATE_LEDGER_HOT_SIZE", "10000"))
+UPDATE_LEDGER_PRUNE_INTERVAL = float(os.getenv("UPDATE_LEDGER_PRUNE_INTERVAL", "3600"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "10"))
+MEMORY_SNAPSHOT_DIR = os.getenv("MEMORY_SNAPSHOT_DIR", "memdumps")
+MEMORY_SNAPSHOT_MAX_FILES = int(os.getenv("MEMORY_SNAPSHOT_MAX_FILES", "20"))
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", "0"))
+MEMORY_TRACE_WINDOW = float(os.getenv("MEMORY_TRACE_WINDOW", "1800"))
+
+FANOUT_TRIGGERS = ("/all", "все:", "all:")
+FANOUT_MODELS = [m.strip() for m in os.getenv("FANOUT_MODELS", "").split(",") if m.strip() in TEXT_BOT_CONFIGS.values()]
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "180"))
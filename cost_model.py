@@ -0,0 +1,94 @@
+import logging
+import random
+from config import COST_MODEL_MIN_SAMPLES, COST_MODEL_DECAY, COST_RECALIBRATE_RATE
+
+FEATURES = 3
+
+def usage_features(usage: dict) -> list[float] | None:
+    if not usage:
+        return None
+    prompt = usage.get("prompt_tokens")
+    completion = usage.get("completion_tokens")
+    if prompt is None or completion is None:
+        return None
+    return [1.0, prompt / 1000, completion / 1000]
+
+def solve(a: list[list[float]], b: list[float]) -> list[float] | None:
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                f = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= f * m[col][c]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+class ModelFit:
+    def __init__(self, stats: dict | None = None):
+        stats = stats or {}
+        self.xtx = stats.get("xtx") or [[0.0] * FEATURES for _ in range(FEATURES)]
+        self.xty = stats.get("xty") or [0.0] * FEATURES
+        self.samples = stats.get("samples", 0)
+        self.coef = None
+        self.refit()
+
+    def to_stats(self) -> dict:
+        return {"xtx": self.xtx, "xty": self.xty, "samples": self.samples}
+
+    def observe(self, x: list[float], y: float):
+        for i in range(FEATURES):
+            self.xty[i] = self.xty[i] * COST_MODEL_DECAY + x[i] * y
+            for j in range(FEATURES):
+                self.xtx[i][j] = self.xtx[i][j] * COST_MODEL_DECAY + x[i] * x[j]
+        self.samples += 1
+        self.refit()
+
+    def refit(self):
+        if self.samples == 0:
+            self.coef = None
+            return
+        ridge = [[self.xtx[i][j] + (1e-6 if i == j else 0.0) for j in range(FEATURES)] for i in range(FEATURES)]
+        self.coef = solve(ridge, self.xty)
+
+    def predict(self, x: list[float]) -> int | None:
+        if self.coef is None:
+            return None
+        return max(0, round(sum(c * v for c, v in zip(self.coef, x))))
+
+class CostModel:
+    def __init__(self):
+        self.fits = {}
+
+    def load(self, rows: dict):
+        self.fits = {bot_key: ModelFit(stats) for bot_key, stats in rows.items()}
+
+    def estimate(self, bot_key: str, usage: dict) -> int | None:
+        fit = self.fits.get(bot_key)
+        x = usage_features(usage)
+        if fit is None or x is None or fit.samples < COST_MODEL_MIN_SAMPLES:
+            return None
+        return fit.predict(x)
+
+    def needs_recalibration(self, bot_key: str) -> bool:
+        fit = self.fits.get(bot_key)
+        if fit is None or fit.samples < COST_MODEL_MIN_SAMPLES:
+            return True
+        return random.random() < COST_RECALIBRATE_RATE
+
+    def observe(self, bot_key: str, usage: dict, points: int):
+        x = usage_features(usage)
+        if x is None or points is None:
+            return None
+        fit = self.fits.setdefault(bot_key, ModelFit())
+        predicted = fit.predict(x)
+        fit.observe(x, float(points))
+        if predicted is not None:
+            logging.info("Cost model %s: predicted %s, actual %s", bot_key, predicted, points)
+        return fit.to_stats()
+
+cost_model = CostModel()
@@ -3,82 +3,40 @@ import pg8000
 import threading
 from datetime import datetime
 from config import DB_CONFIG
+from migrations import apply_migrations
+
+def connect():
+    return pg8000.connect(
+        database=DB_CONFIG["NAME"],
+        user=DB_CONFIG["USER"],
+        password=DB_CONFIG["PASSWORD"],
+        host=DB_CONFIG["HOST"],
+        port=int(DB_CONFIG["PORT"]),
+    )
 
 class Database:
     def __init__(self):
         self.lock = threading.Lock()
-        self.conn = pg8000.connect(
-            database=DB_CONFIG["NAME"],
-            user=DB_CONFIG["USER"],
-            password=DB_CONFIG["PASSWORD"],
-            host=DB_CONFIG["HOST"],
-            port=int(DB_CONFIG["PORT"]),
-        )
-        self.cur = self.conn.cursor()
-        self.create_tables()
-
-    def create_tables(self):
+        self.conn = None
+        self.cur = None
+
+    def open(self):
         with self.lock:
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS chat_contexts (
-                    chat_id BIGINT NOT NULL,
-                    bot_key TEXT NOT NULL,
-                    messages JSONB NOT NULL DEFAULT '[]'::jsonb,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                    PRIMARY KEY (chat_id, bot_key)
-                );
-                """
-            )
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS chat_logs (
-                    id BIGSERIAL PRIMARY KEY,
-                    chat_id BIGINT NOT NULL,
-                    bot_key TEXT,
-                    username TEXT,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """
-            )
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS whitelist (
-                    entity_id BIGINT PRIMARY KEY,
-                    added_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """
-            )
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS usage_stats (
-                    entity_id BIGINT PRIMARY KEY,
-                    total_points BIGINT NOT NULL DEFAULT 0,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """
-            )
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS usage_stats_users (
-                    username TEXT PRIMARY KEY,
-                    total_points BIGINT NOT NULL DEFAULT 0,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """
-            )
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS app_settings (
-                    key TEXT PRIMARY KEY,
-                    value_bool BOOLEAN,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """
-            )
-            self.conn.commit()
+            if self.conn is not None:
+                return
+            self.conn = connect()
+            self.cur = self.conn.cursor()
+            apply_migrations(self.conn, self.cur)
+
+    def close(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+                self.cur = None
 
     def get_context(self, chat_id, bot_key):
         with self.lock:
@@ -111,6 +69,50 @@ class Database:
             )
             self.conn.commit()
 
+    def get_contexts(self, chat_id, bot_keys):
+        with self.lock:
+            self.cur.execute(
+                "SELECT bot_key, messages FROM chat_contexts WHERE chat_id=%s AND bot_key = ANY(%s);",
+                (chat_id, list(bot_keys)),
+            )
+            out = {}
+            for bot_key, val in self.cur.fetchall():
+                if isinstance(val, (dict, list)):
+                    out[bot_key] = val
+                    continue
+                try:
+                    out[bot_key] = json.loads(val)
+                except Exception:
+                    out[bot_key] = []
+            return out
+
+    def save_exchanges(self, chat_id, contexts: dict, logs):
+        now = datetime.utcnow()
+        with self.lock:
+            try:
+                for bot_key, messages in contexts.items():
+                    self.cur.execute(
+                        """
+                        INSERT INTO chat_contexts (chat_id, bot_key, messages, updated_at)
+                        VALUES (%s, %s, %s::jsonb, NOW())
+                        ON CONFLICT (chat_id, bot_key)
+                        DO UPDATE SET messages = EXCLUDED.messages, updated_at = NOW();
+                        """,
+                        (chat_id, bot_key, json.dumps(messages, ensure_ascii=False)),
+                    )
+                for bot_key, username, role, content in logs:
+                    self.cur.execute(
+                        """
+                        INSERT INTO chat_logs (chat_id, bot_key, username, role, content, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s);
+                        """,
+                        (chat_id, bot_key, username, role, content, now),
+                    )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
     def clear_context(self, chat_id, bot_key):
         with self.lock:
             self.cur.execute(
@@ -130,6 +132,50 @@ class Database:
             )
             self.conn.commit()
 
+    def search_logs(self, query: str, chat_id=None, bot_key=None, since=None, until=None, cursor=None, limit: int = 10):
+        conditions = ["content_tsv @@ websearch_to_tsquery('simple', %s)"]
+        params = [query]
+        if chat_id is not None:
+            conditions.append("chat_id = %s")
+            params.append(chat_id)
+        if bot_key is not None:
+            conditions.append("bot_key = %s")
+            params.append(bot_key)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < %s")
+            params.append(until)
+        if cursor is not None:
+            conditions.append("(created_at, id) < (%s, %s)")
+            params.extend(cursor)
+        params.append(limit)
+        with self.lock:
+            self.cur.execute(
+                f"""
+                SELECT id, chat_id, bot_key, username, role, left(content, 200), created_at
+                FROM chat_logs
+                WHERE {" AND ".join(conditions)}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s;
+                """,
+                tuple(params),
+            )
+            rows = self.cur.fetchall()
+            out = []
+            for log_id, chat, bot, username, role, snippet, created_at in rows:
+                out.append({
+                    "id": log_id,
+                    "chat_id": chat,
+                    "bot_key": bot,
+                    "username": username,
+                    "role": role,
+                    "snippet": snippet,
+                    "created_at": created_at,
+                })
+            return out
+
     def is_whitelisted(self, entity_id: int) -> bool:
         with self.lock:
             self.cur.execute("SELECT 1 FROM whitelist WHERE entity_id=%s;", (entity_id,))
@@ -213,19 +259,6 @@ class Database:
                 })
             return out
 
-    def increment_usage_username(self, username: str, points: int):
-        with self.lock:
-            self.cur.execute(
-                """
-                INSERT INTO usage_stats_users (username, total_points, updated_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (username)
-                DO UPDATE SET total_points = usage_stats_users.total_points + EXCLUDED.total_points, updated_at = NOW();
-                """,
-                (username, points),
-            )
-            self.conn.commit()
-
     def list_usage_leaderboard_usernames(self):
         with self.lock:
             self.cur.execute(
@@ -245,6 +278,63 @@ class Database:
                 })
             return out
 
+    def record_usage(self, username: str | None, chat_id: int, bot_key: str, points: int):
+        with self.lock:
+            if username:
+                self.cur.execute(
+                    """
+                    INSERT INTO usage_stats_users (username, total_points, updated_at)
+                    VALUES (%s, %s, NOW())
+                    ON CONFLICT (username)
+                    DO UPDATE SET total_points = usage_stats_users.total_points + EXCLUDED.total_points, updated_at = NOW();
+                    """,
+                    (username, points),
+                )
+            self.cur.execute(
+                """
+                INSERT INTO usage_rollups (bucket, username, chat_id, bot_key, points, requests)
+                VALUES (date_trunc('hour', NOW()), %s, %s, %s, %s, 1)
+                ON CONFLICT (bucket, username, chat_id, bot_key)
+                DO UPDATE SET points = usage_rollups.points + EXCLUDED.points, requests = usage_rollups.requests + 1;
+                """,
+                (username or "", chat_id, bot_key, points),
+            )
+            self.conn.commit()
+
+    def list_usage_rollup_leaderboard(self, hours: int | None):
+        with self.lock:
+            if hours is None:
+                self.cur.execute(
+                    """
+                    SELECT username, SUM(points) AS total_points, SUM(requests)
+                    FROM usage_rollups
+                    GROUP BY username
+                    HAVING SUM(points) > 0
+                    ORDER BY total_points DESC;
+                    """
+                )
+            else:
+                self.cur.execute(
+                    """
+                    SELECT username, SUM(points) AS total_points, SUM(requests)
+                    FROM usage_rollups
+                    WHERE bucket >= date_trunc('hour', NOW()) - make_interval(hours => %s)
+                    GROUP BY username
+                    HAVING SUM(points) > 0
+                    ORDER BY total_points DESC;
+                    """,
+                    (hours,),
+                )
+            rows = self.cur.fetchall()
+            out = []
+            for username, total_points, requests in rows:
+                out.append({
+                    "username": username,
+                    "total_points": int(total_points) if total_points is not None else 0,
+                    "requests": int(requests) if requests is not None else 0,
+                })
+            return out
+
     def reset_usage_leaderboard_usernames(self):
         with self.lock:
             self.cur.execute("DELETE FROM usage_stats_users;")
@@ -286,4 +376,78 @@ class Database:
                 """,
                 (f"cq:{chat_id}", value),
             )
-            self.conn.commit()
\ No newline at end of file
+            self.conn.commit()
+
+    def get_cost_models(self):
+        with self.lock:
+            self.cur.execute("SELECT bot_key, stats FROM cost_models;")
+            rows = self.cur.fetchall()
+            out = {}
+            for bot_key, stats in rows:
+                out[bot_key] = stats if isinstance(stats, dict) else json.loads(stats)
+            return out
+
+    def save_cost_model(self, bot_key: str, stats: dict):
+        with self.lock:
+            self.cur.execute(
+                """
+                INSERT INTO cost_models (bot_key, stats, updated_at)
+                VALUES (%s, %s::jsonb, NOW())
+                ON CONFLICT (bot_key)
+                DO UPDATE SET stats = EXCLUDED.stats, updated_at = NOW();
+                """,
+                (bot_key, json.dumps(stats)),
+            )
+            self.conn.commit()
+
+    def get_budget_buckets(self):
+        with self.lock:
+            self.cur.execute("SELECT scope, entity_id, tokens, updated, capacity_override FROM budget_buckets;")
+            return [tuple(r) for r in self.cur.fetchall()]
+
+    def save_budget_buckets(self, rows):
+        with self.lock:
+            for row in rows:
+                self.cur.execute(
+                    """
+                    INSERT INTO budget_buckets (scope, entity_id, tokens, updated, capacity_override)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (scope, entity_id)
+                    DO UPDATE SET tokens = EXCLUDED.tokens, updated = EXCLUDED.updated, capacity_override = EXCLUDED.capacity_override;
+                    """,
+                    row,
+                )
+            self.conn.commit()
+
+    def claim_message(self, chat_id: int, message_id: int) -> bool:
+        with self.lock:
+            self.cur.execute(
+                """
+                INSERT INTO processed_messages (chat_id, message_id)
+                VALUES (%s, %s)
+                ON CONFLICT (chat_id, message_id) DO NOTHING
+                RETURNING 1;
+                """,
+                (chat_id, message_id),
+            )
+            claimed = self.cur.fetchone() is not None
+            self.conn.commit()
+            return claimed
+
+    def release_message(self, chat_id: int, message_id: int):
+        with self.lock:
+            self.cur.execute(
+                "DELETE FROM processed_messages WHERE chat_id = %s AND message_id = %s;",
+                (chat_id, message_id),
+            )
+            self.conn.commit()
+
+    def prune_processed_messages(self, ttl_seconds: float) -> int:
+        with self.lock:
+            self.cur.execute(
+                "DELETE FROM processed_messages WHERE processed_at < NOW() - make_interval(secs => %s);",
+                (ttl_seconds,),
+            )
+            deleted = self.cur.rowcount
+            self.conn.commit()
+            return deleted
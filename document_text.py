@@ -0,0 +1,100 @@
+import asyncio
+import io
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from config import DOC_TEXT_MAX_CHARS, DOC_TEXT_CACHE_SIZE, DOC_WORKERS
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+TEXT_MIME_TYPES = {
+    "application/json", "application/xml", "application/javascript", "application/x-javascript",
+    "application/x-yaml", "application/yaml", "application/toml", "application/x-sh",
+    "application/sql", "application/x-python", "application/csv",
+}
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".json", ".jsonl", ".xml", ".yaml", ".yml",
+    ".toml", ".ini", ".cfg", ".conf", ".log", ".sql", ".html", ".htm", ".css", ".scss",
+    ".py", ".js", ".ts", ".tsx", ".jsx", ".java", ".kt", ".c", ".h", ".cpp", ".hpp", ".cs",
+    ".go", ".rs", ".rb", ".php", ".swift", ".sh", ".bat", ".ps1", ".lua", ".r", ".tex",
+}
+ENCODINGS = ("utf-8-sig", "cp1251")
+
+executor = None
+
+def is_pdf(filename: str, mime_type: str) -> bool:
+    return mime_type == "application/pdf" or filename.lower().endswith(".pdf")
+
+def is_text_document(filename: str, mime_type: str) -> bool:
+    if is_pdf(filename, mime_type):
+        return PdfReader is not None
+    if mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES:
+        return True
+    return os.path.splitext(filename.lower())[1] in TEXT_EXTENSIONS
+
+def extract_text(data: bytes, filename: str, mime_type: str) -> str | None:
+    if is_pdf(filename, mime_type):
+        reader = PdfReader(io.BytesIO(data))
+        pages = [page.extract_text() or "" for page in reader.pages]
+        text = "\n\n".join(pages).strip()
+        if len(text) < 20 * max(1, len(pages)):
+            return None
+        return text
+    if b"\x00" in data[:8192]:
+        return None
+    for encoding in ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return None
+
+class DocumentTextCache:
+    def __init__(self, max_entries: int = DOC_TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, file_unique_id: str):
+        text = self.entries.get(file_unique_id)
+        if text is not None:
+            self.entries.move_to_end(file_unique_id)
+        return text
+
+    def put(self, file_unique_id: str, text: str):
+        self.entries[file_unique_id] = text
+        self.entries.move_to_end(file_unique_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+document_cache = DocumentTextCache()
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=DOC_WORKERS)
+    return executor
+
+async def document_text(data: bytes, filename: str, mime_type: str, file_unique_id: str, request_id: str = "N/A") -> str | None:
+    loop = asyncio.get_running_loop()
+    try:
+        text = await loop.run_in_executor(get_executor(), extract_text, data, filename, mime_type)
+    except Exception as e:
+        logging.warning("[%s] Text extraction failed for %s: %s", request_id, filename, e)
+        return None
+    if text is None or len(text) > DOC_TEXT_MAX_CHARS:
+        return None
+    document_cache.put(file_unique_id, text)
+    return text
+
+def text_attachment(filename: str, text: str) -> dict:
+    return {"filename": filename, "content_type": "text/plain", "text": text}
+
+def shutdown_executor():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
@@ -1,4 +1,19 @@
 from database import Database
+from cost_model import cost_model
+from budgets import budgets
 
 db = Database()
-economy_mode = db.get_economy_mode()
\ No newline at end of file
+economy_mode = False
+# Set by a worker process to forward state changes to its siblings via the supervisor.
+broadcast = None
+
+def init():
+    global economy_mode
+    db.open()
+    economy_mode = db.get_economy_mode()
+    cost_model.load(db.get_cost_models())
+    budgets.load(db.get_budget_buckets())
+
+def publish(event: dict):
+    if broadcast is not None:
+        broadcast(event)
\ No newline at end of file
@@ -0,0 +1,15 @@
+import aiohttp
+
+session = None
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession()
+    return session
+
+async def close_session():
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
\ No newline at end of file
@@ -0,0 +1,118 @@
+import asyncio
+import base64
+import ipaddress
+import logging
+import socket
+import tempfile
+from urllib.parse import urlsplit
+from aiogram.types import Message, InputFile, InputMediaPhoto, InputMediaDocument
+from config import IMAGE_OUTPUT_MAX_BYTES
+from http_session import get_session
+
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_TYPES = {"image/jpeg", "image/png", "image/webp"}
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+MEDIA_GROUP_LIMIT = 10
+
+class SpooledInputFile(InputFile):
+    def __init__(self, spool, filename: str, chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.spool = spool
+
+    async def read(self, bot):
+        self.spool.seek(0)
+        while chunk := self.spool.read(self.chunk_size):
+            yield chunk
+
+class ImageOutput:
+    def __init__(self, spool, filename: str, content_type: str, size: int):
+        self.spool = spool
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+
+    def as_input_file(self):
+        return SpooledInputFile(self.spool, self.filename)
+
+    @property
+    def fits_photo(self) -> bool:
+        return self.content_type in PHOTO_TYPES and self.size <= PHOTO_MAX_BYTES
+
+def decode_data_image(att: dict) -> ImageOutput:
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    spool.write(base64.b64decode(att["data_base64"]))
+    return ImageOutput(spool, att["filename"], att["content_type"], spool.tell())
+
+async def check_public_url(url: str):
+    parts = urlsplit(url)
+    if parts.scheme != "https" or not parts.hostname:
+        raise ValueError(f"refusing to fetch non-https image URL {url}")
+    infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, parts.port or 443, type=socket.SOCK_STREAM)
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"refusing to fetch image from non-public address {ip}")
+
+async def download_image(att: dict, request_id: str) -> ImageOutput:
+    await check_public_url(att["url"])
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    logging.info("[%s] Downloading generated image %s", request_id, att["url"])
+    try:
+        async with get_session().get(att["url"], timeout=60, allow_redirects=False) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if not content_type.startswith("image/"):
+                raise ValueError(f"unexpected Content-Type {content_type or 'none'} for generated image")
+            if (resp.content_length or 0) > IMAGE_OUTPUT_MAX_BYTES:
+                raise ValueError(f"generated image is larger than {IMAGE_OUTPUT_MAX_BYTES} bytes")
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                spool.write(chunk)
+                if spool.tell() > IMAGE_OUTPUT_MAX_BYTES:
+                    raise ValueError(f"generated image is larger than {IMAGE_OUTPUT_MAX_BYTES} bytes")
+    except Exception:
+        spool.close()
+        raise
+    filename = att["filename"]
+    if "." not in filename:
+        filename += "." + content_type.split("/")[-1]
+    return ImageOutput(spool, filename, content_type, spool.tell())
+
+async def load_image(att: dict, request_id: str) -> ImageOutput:
+    if "url" in att:
+        return await download_image(att, request_id)
+    return await asyncio.to_thread(decode_data_image, att)
+
+async def send_image_outputs(message: Message, attachments: list[dict], request_id: str = "N/A"):
+    if not attachments:
+        return
+    results = await asyncio.gather(*(load_image(att, request_id) for att in attachments), return_exceptions=True)
+    images = []
+    for res in results:
+        if isinstance(res, Exception):
+            logging.error("[%s] Failed to load generated image: %s", request_id, res)
+        else:
+            images.append(res)
+    try:
+        if not images:
+            await message.reply("Не удалось загрузить сгенерированное изображение.", parse_mode=None)
+            return
+        as_photos = all(img.fits_photo for img in images)
+        for i in range(0, len(images), MEDIA_GROUP_LIMIT):
+            group = images[i:i + MEDIA_GROUP_LIMIT]
+            if len(group) == 1:
+                if as_photos:
+                    await message.reply_photo(group[0].as_input_file())
+                else:
+                    await message.reply_document(group[0].as_input_file())
+                continue
+            if as_photos:
+                media = [InputMediaPhoto(media=img.as_input_file()) for img in group]
+            else:
+                media = [InputMediaDocument(media=img.as_input_file()) for img in group]
+            await message.reply_media_group(media)
+    except Exception as e:
+        logging.exception("[%s] Failed to send generated images", request_id, exc_info=e)
+    finally:
+        for img in images:
+            img.spool.close()
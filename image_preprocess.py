@@ -0,0 +1,79 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_MODEL_TARGETS, IMAGE_WORKERS
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+RESIZABLE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/bmp", "image/tiff"}
+# Re-encoding PNG or WebP as JPEG would blur screenshots and drop transparency.
+KEPT_FORMATS = {"PNG": "image/png", "WEBP": "image/webp"}
+EXIF_ORIENTATION = 0x0112
+
+executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-preprocess")
+
+def image_target(model: str) -> tuple[int, int]:
+    return IMAGE_MODEL_TARGETS.get(model, (IMAGE_MAX_SIDE, IMAGE_QUALITY))
+
+def pick_photo_size(photo_sizes: list, model: str):
+    max_side, _ = image_target(model)
+    if max_side <= 0:
+        return photo_sizes[-1]
+    for size in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        if max(size.width, size.height) >= max_side:
+            return size
+    return photo_sizes[-1]
+
+def shrink_image(data: bytes, max_side: int, quality: int) -> tuple[bytes, str, bool] | None:
+    with Image.open(io.BytesIO(data)) as img:
+        if getattr(img, "is_animated", False):
+            return None
+        source_format = img.format
+        # Telegram leaves image documents untouched, so phone photos sent as files
+        # still rely on the EXIF tag that re-encoding would drop.
+        rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+        if not rotated and max(img.size) <= max_side:
+            return None
+        if rotated:
+            img = ImageOps.exif_transpose(img)
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        if source_format in KEPT_FORMATS:
+            if source_format == "PNG":
+                img.save(out, format="PNG", optimize=True)
+            else:
+                img.save(out, format="WEBP", quality=quality)
+            return out.getvalue(), KEPT_FORMATS[source_format], rotated
+        if img.mode in ("RGBA", "LA"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue(), "image/jpeg", rotated
+
+async def preprocess_image(data: bytes, mime_type: str, model: str, request_id: str = "N/A") -> tuple[bytes, str]:
+    max_side, quality = image_target(model)
+    if Image is None or max_side <= 0 or mime_type not in RESIZABLE_TYPES:
+        return data, mime_type
+    loop = asyncio.get_running_loop()
+    try:
+        shrunk = await loop.run_in_executor(executor, shrink_image, data, max_side, quality)
+    except Exception as e:
+        logging.warning("[%s] Image preprocessing failed, sending original: %s", request_id, e)
+        return data, mime_type
+    if shrunk is None:
+        return data, mime_type
+    shrunk_data, shrunk_type, rotated = shrunk
+    # A rotated image is kept even when larger; the original would reach the model sideways.
+    if not rotated and len(shrunk_data) >= len(data):
+        return data, mime_type
+    return shrunk_data, shrunk_type
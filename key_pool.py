@@ -0,0 +1,58 @@
+import time
+from collections import deque
+from config import POE_API_KEYS, POE_KEY_MIN_BALANCE, POE_KEY_COOLDOWN
+
+class PoeKey:
+    def __init__(self, key: str):
+        self.key = key
+        self.label = "…" + key[-4:]
+        self.balance = None
+        self.points_spent = 0
+        self.requests = 0
+        self.rate_limits = deque(maxlen=20)
+        self.cooldown_until = 0.0
+        self.exhausted = False
+
+    def recent_rate_limits(self, window: float = 600) -> int:
+        now = time.monotonic()
+        return sum(1 for t in self.rate_limits if now - t < window)
+
+    def score(self) -> float:
+        balance = self.balance if self.balance is not None else float("inf")
+        return balance / (1 + self.recent_rate_limits())
+
+class KeyPool:
+    def __init__(self, keys: list[str]):
+        self.keys = [PoeKey(k) for k in keys]
+
+    def acquire(self, exclude=()) -> PoeKey:
+        now = time.monotonic()
+        candidates = [k for k in self.keys if not k.exhausted and k not in exclude]
+        if not candidates:
+            raise Exception("All Poe API keys are exhausted")
+        ready = [k for k in candidates if k.cooldown_until <= now] or candidates
+        key = max(ready, key=lambda k: (k.score(), -k.requests))
+        key.requests += 1
+        return key
+
+    def report_rate_limit(self, key: PoeKey, retry_after: float | None = None):
+        key.rate_limits.append(time.monotonic())
+        key.cooldown_until = time.monotonic() + (retry_after or POE_KEY_COOLDOWN)
+
+    def mark_exhausted(self, key: PoeKey):
+        key.exhausted = True
+
+    def set_balance(self, key: PoeKey, balance: int):
+        key.balance = balance
+        key.exhausted = balance <= POE_KEY_MIN_BALANCE
+
+    def charge(self, key: PoeKey, points: int):
+        key.points_spent += points
+        if key.balance is not None:
+            self.set_balance(key, key.balance - points)
+
+    def total_balance(self):
+        known = [k.balance for k in self.keys if k.balance is not None]
+        return sum(known) if known else None
+
+key_pool = KeyPool(POE_API_KEYS)
\ No newline at end of file
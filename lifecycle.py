@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+class InflightTracker:
+    def __init__(self):
+        self.tasks = set()
+
+    @contextmanager
+    def track(self):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            yield
+        finally:
+            self.tasks.discard(task)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self, timeout: float) -> int:
+        pending = {t for t in self.tasks if not t.done()}
+        if not pending:
+            return 0
+        logging.info("Waiting up to %ss for %s in-flight requests...", timeout, len(pending))
+        done, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning("Cancelled %s requests still running after %ss", len(pending), timeout)
+            await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+inflight = InflightTracker()
+
+class ModelRequest:
+    def __init__(self, task, chat_id: int, message_id: int, model: str):
+        self.task = task
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.model = model
+        self.reason = None
+        self.committed = False
+        # Messages of the media group, kept so a re-run after an edit gets the
+        # whole album instead of only the captioned item.
+        self.album = None
+
+class ModelRequestRegistry:
+    # Requests are cancellable until they are marked committed (the model has
+    # answered and the reply will be delivered); after that, cancel only stops
+    # the context write.
+    def __init__(self):
+        self.by_task = {}
+        self.by_message = defaultdict(set)
+        self.by_model = defaultdict(set)
+
+    def register(self, chat_id: int, message_id: int, model: str, album: list | None = None) -> ModelRequest:
+        task = asyncio.current_task()
+        req = ModelRequest(task, chat_id, message_id, model)
+        req.album = album
+        self.by_task[task] = req
+        self.by_message[(chat_id, message_id)].add(req)
+        self.by_model[(chat_id, model)].add(req)
+        return req
+
+    def discard(self, task):
+        req = self.by_task.pop(task, None)
+        if req is None:
+            return
+        for index, key in ((self.by_message, (req.chat_id, req.message_id)), (self.by_model, (req.chat_id, req.model))):
+            reqs = index.get(key)
+            if reqs is not None:
+                reqs.discard(req)
+                if not reqs:
+                    del index[key]
+
+    def cancel(self, req: ModelRequest, reason: str) -> bool:
+        if req.reason is not None:
+            return False
+        req.reason = reason
+        if not req.committed:
+            req.task.cancel()
+        logging.info("Cancelling %s request for message %s in chat %s: %s", req.model, req.message_id, req.chat_id, reason)
+        return True
+
+    def cancel_message(self, chat_id: int, message_id: int, reason: str) -> list[ModelRequest]:
+        reqs = list(self.by_message.get((chat_id, message_id), ()))
+        return [req for req in reqs if not req.committed and self.cancel(req, reason)]
+
+    def cancel_model(self, chat_id: int, model: str, reason: str) -> int:
+        return sum(self.cancel(req, reason) for req in list(self.by_model.get((chat_id, model), ())))
+
+    def cancel_where(self, predicate, reason: str) -> int:
+        return sum(self.cancel(req, reason) for req in list(self.by_task.values()) if predicate(req))
+
+model_requests = ModelRequestRegistry()
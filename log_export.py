@@ -0,0 +1,70 @@
+import gzip
+import os
+import tempfile
+from aiogram.types import InputFile
+from database import connect
+
+TELEGRAM_UPLOAD_LIMIT = 49 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+def sql_literal_time(value) -> str:
+    return f"'{value.strftime('%Y-%m-%d %H:%M:%S%z')}'::timestamptz"
+
+def build_export_query(chat_id=None, bot_key=None, since=None, until=None) -> str:
+    conditions = []
+    if chat_id is not None:
+        conditions.append(f"chat_id = {int(chat_id)}")
+    if bot_key is not None:
+        conditions.append("bot_key = '" + bot_key.replace("'", "''") + "'")
+    if since is not None:
+        conditions.append(f"created_at >= {sql_literal_time(since)}")
+    if until is not None:
+        conditions.append(f"created_at < {sql_literal_time(until)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return (
+        "COPY (SELECT id, chat_id, bot_key, username, role, content, created_at "
+        f"FROM chat_logs {where} ORDER BY created_at, id) TO STDOUT WITH (FORMAT csv, HEADER true)"
+    )
+
+def export_logs(**filters) -> str:
+    fd, path = tempfile.mkstemp(prefix="chat_logs_", suffix=".csv.gz")
+    conn = connect()
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            cur = conn.cursor()
+            cur.execute(build_export_query(**filters), stream=gz)
+        conn.commit()
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        conn.close()
+    return path
+
+class FileRangeInputFile(InputFile):
+    def __init__(self, path: str, offset: int, length: int, filename: str, chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    async def read(self, bot):
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+def export_parts(path: str, filename: str) -> list[FileRangeInputFile]:
+    size = os.path.getsize(path)
+    if size <= TELEGRAM_UPLOAD_LIMIT:
+        return [FileRangeInputFile(path, 0, size, filename)]
+    parts = []
+    for idx, offset in enumerate(range(0, size, TELEGRAM_UPLOAD_LIMIT), start=1):
+        length = min(TELEGRAM_UPLOAD_LIMIT, size - offset)
+        parts.append(FileRangeInputFile(path, offset, length, f"{filename}.part{idx}"))
+    return parts
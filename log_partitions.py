@@ -0,0 +1,150 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import date
+from database import connect
+from config import LOG_PARTITION_MONTHS_AHEAD, LOG_RETENTION_MONTHS, LOG_ARCHIVE_DIR, LOG_MAINTENANCE_INTERVAL
+
+UPPER_BOUND_RE = re.compile(r"TO \('(\d{4})-(\d{2})-(\d{2})")
+
+def add_months(d: date, months: int) -> date:
+    idx = d.year * 12 + d.month - 1 + months
+    return date(idx // 12, idx % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f"chat_logs_p{month.year:04d}{month.month:02d}"
+
+class LogPartitionManager:
+    def __init__(self, months_ahead: int = LOG_PARTITION_MONTHS_AHEAD, retention_months: int = LOG_RETENTION_MONTHS, archive_dir: str = LOG_ARCHIVE_DIR):
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.task = None
+
+    def run_maintenance(self):
+        conn = connect()
+        try:
+            cur = conn.cursor()
+            self.ensure_partitioned(conn, cur)
+            self.ensure_partitions(conn, cur)
+            if self.retention_months > 0:
+                self.apply_retention(conn, cur)
+        finally:
+            conn.close()
+
+    def ensure_partitioned(self, conn, cur):
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('chat_logs');")
+        row = cur.fetchone()
+        if row and row[0] == "p":
+            return
+        next_month = add_months(date.today().replace(day=1), 1)
+        logging.info("Converting chat_logs to a partitioned table...")
+        try:
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS chat_logs_id_seq;")
+            if row:
+                cur.execute("ALTER TABLE chat_logs RENAME TO chat_logs_legacy;")
+                cur.execute("ALTER TABLE chat_logs_legacy RENAME CONSTRAINT chat_logs_pkey TO chat_logs_legacy_pkey;")
+                cur.execute("ALTER INDEX IF EXISTS chat_logs_content_tsv_idx RENAME TO chat_logs_legacy_content_tsv_idx;")
+            cur.execute(
+                """
+                CREATE TABLE chat_logs (
+                    id BIGINT NOT NULL DEFAULT nextval('chat_logs_id_seq'),
+                    chat_id BIGINT NOT NULL,
+                    bot_key TEXT,
+                    username TEXT,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+                    PRIMARY KEY (id, created_at)
+                ) PARTITION BY RANGE (created_at);
+                """
+            )
+            cur.execute("ALTER SEQUENCE chat_logs_id_seq OWNED BY chat_logs.id;")
+            cur.execute("CREATE INDEX IF NOT EXISTS chat_logs_chat_created_idx ON chat_logs (chat_id, created_at);")
+            cur.execute("CREATE INDEX IF NOT EXISTS chat_logs_content_tsv_idx ON chat_logs USING GIN (content_tsv);")
+            if row:
+                cur.execute(
+                    f"ALTER TABLE chat_logs ATTACH PARTITION chat_logs_legacy FOR VALUES FROM (MINVALUE) TO ('{next_month.isoformat()} 00:00:00+00');"
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def list_partitions(self, cur):
+        cur.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'chat_logs'::regclass;
+            """
+        )
+        out = []
+        for name, bound in cur.fetchall():
+            m = UPPER_BOUND_RE.search(bound or "")
+            if m:
+                out.append((name, date(int(m.group(1)), int(m.group(2)), int(m.group(3)))))
+        return out
+
+    def ensure_partitions(self, conn, cur):
+        partitions = self.list_partitions(cur)
+        highest = max((upper for _, upper in partitions), default=None)
+        current = date.today().replace(day=1)
+        try:
+            for offset in range(self.months_ahead + 1):
+                start = add_months(current, offset)
+                if highest is not None and start < highest:
+                    continue
+                end = add_months(start, 1)
+                name = partition_name(start)
+                logging.info("Creating chat_logs partition %s", name)
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF chat_logs "
+                    f"FOR VALUES FROM ('{start.isoformat()} 00:00:00+00') TO ('{end.isoformat()} 00:00:00+00');"
+                )
+                highest = end
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def apply_retention(self, conn, cur):
+        cutoff = add_months(date.today().replace(day=1), -self.retention_months)
+        for name, upper in sorted(self.list_partitions(cur), key=lambda p: p[1]):
+            if upper > cutoff:
+                continue
+            os.makedirs(self.archive_dir, exist_ok=True)
+            path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+            logging.info("Archiving expired chat_logs partition %s to %s", name, path)
+            try:
+                cur.execute(f"ALTER TABLE chat_logs DETACH PARTITION {name};")
+                with gzip.open(path, "wb") as f:
+                    cur.execute(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER true);", stream=f)
+                cur.execute(f"DROP TABLE {name};")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.maintenance_loop())
+
+    async def maintenance_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_maintenance)
+            except Exception as e:
+                logging.error("chat_logs partition maintenance failed: %s", e)
+            await asyncio.sleep(LOG_MAINTENANCE_INTERVAL)
+
+log_partitions = LogPartitionManager()
@@ -0,0 +1,68 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import re
+from config import LOG_LEVEL, LOG_FORMAT
+
+REQUEST_ID_RE = re.compile(r"^\[([^\]]+)\] ")
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Arguments are interpolated here, in the calling thread, so the record
+    # captures them as they were when logged and the listener never touches
+    # live objects. Tracebacks are still rendered by the listener from exc_info.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        request_id = getattr(record, "request_id", None)
+        message = record.getMessage()
+        if request_id is None:
+            m = REQUEST_ID_RE.match(message)
+            if m:
+                request_id, message = m.group(1), message[m.end():]
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "message": message,
+        }
+        if request_id is not None:
+            entry["request_id"] = str(request_id)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+listener = None
+
+def setup_logging(tag: str = ""):
+    global listener
+    if listener is not None:
+        listener.stop()
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s {tag}%(message)s" if tag else "%(asctime)s %(levelname)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
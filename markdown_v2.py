@@ -0,0 +1,148 @@
+import re
+from collections import Counter
+
+RESERVED = set("_*[]()~`>#+-=|{}.!")
+UNESCAPE_RE = re.compile(r"\\([_*\[\]()~`>#+\-=|{}.!\\])")
+MAX_REPAIRS = 50
+
+ENTITY_NAMES = {
+    "*": "bold",
+    "_": "italic",
+    "__": "underline",
+    "~": "strikethrough",
+    "||": "spoiler",
+    "`": "code",
+    "```": "pre",
+    "[": "link",
+}
+
+# valid / repaired / plain are decided locally, rejected counts chunks Telegram still refused
+markdown_stats = Counter()
+
+def entity_delimiter(text: str, i: int) -> str | None:
+    c = text[i]
+    if c == "`":
+        return "```" if text.startswith("```", i) else "`"
+    if c == "_":
+        # Telegram always reads "__" as underline, even inside italic, so "___"
+        # closes underline first and italic with the last underscore.
+        return "__" if text.startswith("__", i) else "_"
+    if c == "|":
+        return "||" if text.startswith("||", i) else None
+    if c in "*~[":
+        return c
+    return None
+
+def find_markdown_v2_error(text: str) -> tuple[int, int, str] | None:
+    """Mirror Telegram's MarkdownV2 parser closely enough to find the first error.
+
+    Returns (offset, length, reason) where text[offset:offset + length] is the
+    markup that has to be escaped, or None if the text should parse.
+    """
+    stack = []
+    n = len(text)
+    i = 0
+    line_start = True
+    in_quote = False
+    quote_base = 0
+
+    def unclosed(reason: str):
+        delim, pos, length = stack[-1]
+        return pos, length, f"{ENTITY_NAMES[delim]} entity {reason}"
+
+    while i < n:
+        c = text[i]
+        top = stack[-1][0] if stack else None
+        if line_start and top not in ("`", "```"):
+            line_start = False
+            marker = 3 if text.startswith("**>", i) else 1 if c == ">" else 0
+            if marker:
+                if not in_quote:
+                    if stack:
+                        return unclosed("crosses the start of a quote")
+                    in_quote = True
+                    quote_base = len(stack)
+                i += marker
+                continue
+            if in_quote:
+                if len(stack) > quote_base:
+                    return unclosed("crosses the end of a quote")
+                in_quote = False
+        line_start = False
+        if c == "\\":
+            if i + 1 < n and 0 < ord(text[i + 1]) <= 126:
+                line_start = text[i + 1] == "\n"
+                i += 2
+            else:
+                i += 1
+            continue
+        if c == "\n":
+            line_start = True
+            i += 1
+            continue
+        if top == "```":
+            if text.startswith("```", i):
+                stack.pop()
+                i += 3
+            else:
+                i += 1
+            continue
+        if top == "`":
+            if c == "`":
+                stack.pop()
+            i += 1
+            continue
+        if c not in RESERVED:
+            i += 1
+            continue
+        if c == "]" and top == "[":
+            stack.pop()
+            i += 1
+            if text.startswith("(", i):
+                j = i + 1
+                while j < n and text[j] != ")":
+                    j += 2 if text[j] == "\\" else 1
+                if j >= n:
+                    return i, 1, "link URL is not closed"
+                i = j + 1
+            continue
+        if in_quote and top != "||" and text.startswith("||", i) and (i + 2 == n or text[i + 2] == "\n"):
+            if len(stack) > quote_base:
+                return unclosed("crosses the end of a quote")
+            in_quote = False
+            i += 2
+            continue
+        if c == "!" and text.startswith("![", i):
+            stack.append(("[", i, 2))
+            i += 2
+            continue
+        delim = entity_delimiter(text, i)
+        if delim is None:
+            return i, 1, f"character '{c}' must be escaped"
+        if delim == top:
+            stack.pop()
+        elif any(d == delim for d, _, _ in stack):
+            return i, len(delim), f"{ENTITY_NAMES[delim]} entity overlaps another {ENTITY_NAMES[delim]} entity"
+        else:
+            stack.append((delim, i, len(delim)))
+        i += len(delim)
+    if stack:
+        return unclosed("is not closed")
+    return None
+
+def plain_text(text: str) -> str:
+    return UNESCAPE_RE.sub(r"\1", text)
+
+def repair_markdown_v2(text: str) -> tuple[str, str]:
+    """Escape offending markup until the chunk parses; give up to plain text after MAX_REPAIRS.
+
+    Returns the text to send and one of "valid", "repaired" or "plain".
+    """
+    repaired = text
+    for attempt in range(MAX_REPAIRS + 1):
+        error = find_markdown_v2_error(repaired)
+        if error is None:
+            return repaired, "valid" if attempt == 0 else "repaired"
+        pos, length, _ = error
+        repaired = repaired[:pos] + "".join("\\" + ch for ch in repaired[pos:pos + length]) + repaired[pos + length:]
+    return plain_text(text), "plain"
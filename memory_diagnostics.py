@@ -0,0 +1,147 @@
+import asyncio
+import gc
+import logging
+import os
+import time
+import tracemalloc
+from collections import Counter
+from config import MEMORY_TRACE_FRAMES, MEMORY_SNAPSHOT_DIR, MEMORY_SNAPSHOT_MAX_FILES, MEMORY_SNAPSHOT_INTERVAL, MEMORY_TRACE_WINDOW
+from lifecycle import inflight, model_requests
+from document_text import document_cache
+from albums import album_collector
+from budgets import budgets
+from update_ledger import update_ledger
+
+TRACKED_TYPES = ("Base64Source", "ImageOutput", "SpooledTemporaryFile", "ClientResponse", "Message")
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MiB" if abs(size) >= 1024 * 1024 else f"{size / 1024:.1f} KiB"
+
+class MemoryDiagnostics:
+    def __init__(self):
+        self.frames = MEMORY_TRACE_FRAMES
+        self.directory = MEMORY_SNAPSHOT_DIR
+        self.max_files = MEMORY_SNAPSHOT_MAX_FILES
+        self.interval = MEMORY_SNAPSHOT_INTERVAL
+        self.window = MEMORY_TRACE_WINDOW
+        self.previous = None
+        self.previous_at = None
+        self.task = None
+        self.expiry = None
+
+    def live_counts(self) -> dict:
+        # Must run on the event loop thread; everything here is a cheap len().
+        return {
+            "asyncio tasks": len(asyncio.all_tasks()),
+            "in-flight requests": len(inflight.tasks),
+            "model requests": len(model_requests.by_task),
+            "document text cache": len(document_cache.entries),
+            "pending albums": len(album_collector.groups),
+            "budget buckets": len(budgets.buckets),
+            "ledger hot set": len(update_ledger.hot),
+        }
+
+    def snapshot_report(self, limit: int) -> list[str]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+            self.previous_at = time.time()
+            return ["Трассировка памяти включена, следующий снимок покажет разницу."]
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Отслеживается: {format_size(current)}, пик: {format_size(peak)}"]
+        if self.previous is not None:
+            lines.append(f"Рост с предыдущего снимка ({int(time.time() - self.previous_at)} с назад):")
+            for stat in snapshot.compare_to(self.previous, "lineno")[:limit]:
+                frame = stat.traceback[0]
+                lines.append(f"{format_size(stat.size_diff):>11} ({stat.count_diff:+d}) {os.path.basename(frame.filename)}:{frame.lineno}")
+        else:
+            lines.append("Крупнейшие места выделения:")
+            for stat in snapshot.statistics("lineno")[:limit]:
+                frame = stat.traceback[0]
+                lines.append(f"{format_size(stat.size):>11} ({stat.count}) {os.path.basename(frame.filename)}:{frame.lineno}")
+        self.previous = snapshot
+        self.previous_at = time.time()
+        try:
+            path = self.dump(snapshot)
+            lines.append(f"Снимок сохранён: {path}")
+        except Exception as e:
+            logging.error("Failed to write memory snapshot: %s", e)
+        return lines
+
+    def object_counts(self) -> Counter:
+        return Counter(name for name in (type(o).__name__ for o in gc.get_objects()) if name in TRACKED_TYPES)
+
+    def dump(self, snapshot) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{int(time.time() * 1000)}.tracemalloc")
+        snapshot.dump(path)
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith(".tracemalloc"))
+        for name in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return path
+
+    async def report(self, limit: int = 10) -> str:
+        live = self.live_counts()
+        lines = await asyncio.to_thread(self.snapshot_report, limit)
+        objects = await asyncio.to_thread(self.object_counts)
+        lines.append("Живые структуры:")
+        lines.extend(f"{name}: {count}" for name, count in live.items())
+        lines.extend(f"{name}: {objects[name]}" for name in TRACKED_TYPES)
+        lines.append(self.tracing_status())
+        return "\n".join(lines)
+
+    def tracing_status(self) -> str:
+        if not tracemalloc.is_tracing():
+            return "Трассировка памяти выключена."
+        if self.task is not None:
+            return "Трассировка памяти активна (MEMORY_SNAPSHOT_INTERVAL), выключить: /debug_mem stop."
+        # Tracing slows every allocation, so a manual session lapses unless it is used.
+        if self.window > 0:
+            if self.expiry is not None:
+                self.expiry.cancel()
+            self.expiry = asyncio.get_running_loop().call_later(self.window, self.stop_tracing)
+            return f"Трассировка памяти активна, отключится через {int(self.window // 60)} мин без запросов или по /debug_mem stop."
+        return "Трассировка памяти активна, выключить: /debug_mem stop."
+
+    def stop_tracing(self) -> bool:
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        self.previous = None
+        self.previous_at = None
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        logging.info("Memory tracing stopped")
+        return True
+
+    def stop(self) -> bool:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        return self.stop_tracing()
+
+    def start(self):
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.snapshot_loop())
+
+    async def snapshot_loop(self):
+        while True:
+            try:
+                report = await self.report()
+                logging.info("Memory snapshot:\n%s", report)
+            except Exception as e:
+                logging.error("Periodic memory snapshot failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+memory_diagnostics = MemoryDiagnostics()
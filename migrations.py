@@ -0,0 +1,148 @@
+import logging
+
+MIGRATIONS_LOCK_KEY = 7324501
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_contexts (
+            chat_id BIGINT NOT NULL,
+            bot_key TEXT NOT NULL,
+            messages JSONB NOT NULL DEFAULT '[]'::jsonb,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, bot_key)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_logs (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            bot_key TEXT,
+            username TEXT,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS whitelist (
+            entity_id BIGINT PRIMARY KEY,
+            added_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_stats (
+            entity_id BIGINT PRIMARY KEY,
+            total_points BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_stats_users (
+            username TEXT PRIMARY KEY,
+            total_points BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS app_settings (
+            key TEXT PRIMARY KEY,
+            value_bool BOOLEAN,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ]),
+    (2, "cost models", [
+        """
+        CREATE TABLE IF NOT EXISTS cost_models (
+            bot_key TEXT PRIMARY KEY,
+            stats JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ]),
+    (3, "budget buckets", [
+        """
+        CREATE TABLE IF NOT EXISTS budget_buckets (
+            scope TEXT NOT NULL,
+            entity_id BIGINT NOT NULL,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated DOUBLE PRECISION NOT NULL,
+            capacity_override BIGINT,
+            PRIMARY KEY (scope, entity_id)
+        );
+        """,
+    ]),
+    (4, "hourly usage rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            bucket TIMESTAMPTZ NOT NULL,
+            username TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            bot_key TEXT NOT NULL,
+            points BIGINT NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, username, chat_id, bot_key)
+        );
+        """,
+    ]),
+    (5, "chat_logs full-text search", [
+        """
+        ALTER TABLE chat_logs
+        ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS chat_logs_content_tsv_idx ON chat_logs USING GIN (content_tsv);
+        """,
+    ]),
+    (6, "processed message ledger", [
+        """
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, message_id)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS processed_messages_processed_at_idx ON processed_messages (processed_at);
+        """,
+    ]),
+]
+
+def applied_versions(cur):
+    cur.execute("SELECT to_regclass('schema_migrations');")
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute("SELECT version FROM schema_migrations;")
+    return {r[0] for r in cur.fetchall()}
+
+def apply_migrations(conn, cur):
+    applied = applied_versions(cur)
+    if applied is not None and all(version in applied for version, _, _ in MIGRATIONS):
+        conn.commit()
+        return
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_KEY,))
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+            """
+        )
+        applied = applied_versions(cur)
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            logging.info("Applying migration %s: %s", version, name)
+            for sql in statements:
+                cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,91 @@
+import asyncio
+import time
+import aiohttp
+import logging
+from config import BALANCE_CACHE_TTL, BALANCE_REFRESH_INTERVAL
+from key_pool import key_pool, PoeKey
+
+async def fetch_current_balance(key: PoeKey, request_id: str = "N/A"):
+    headers = {
+        "Authorization": f"Bearer {key.key}",
+        "Accept-Encoding": "gzip, deflate"
+    }
+    try:
+        logging.info("[%s] Requesting current balance for key %s from Poe API (async)...", request_id, key.label)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                "https://api.poe.com/usage/current_balance",
+                headers=headers,
+                timeout=10
+            ) as resp:
+                logging.info("[%s] Current balance response status: %s", request_id, resp.status)
+                if resp.status != 200:
+                    return None
+                data = await resp.json()
+                bal = data.get("current_point_balance")
+                return int(bal) if bal is not None else None
+    except Exception as e:
+        logging.error("[%s] Error fetching current balance: %s", request_id, e)
+        return None
+
+class BalanceCache:
+    def __init__(self, ttl: float = BALANCE_CACHE_TTL, refresh_interval: float = BALANCE_REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.fetched_at = 0.0
+        self.refreshing = None
+        self.loop_task = None
+
+    @property
+    def value(self):
+        return key_pool.total_balance()
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.fetched_at > self.ttl
+
+    async def get(self, request_id: str = "N/A"):
+        if self.value is None:
+            return await self.refresh(request_id)
+        if self.is_stale():
+            self.refresh_soon(request_id)
+        return self.value
+
+    def refresh_soon(self, request_id: str = "N/A"):
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.create_task(self.do_refresh(request_id))
+        return self.refreshing
+
+    async def refresh(self, request_id: str = "N/A"):
+        return await asyncio.shield(self.refresh_soon(request_id))
+
+    async def do_refresh(self, request_id: str):
+        balances = await asyncio.gather(*(fetch_current_balance(k, request_id) for k in key_pool.keys))
+        for key, balance in zip(key_pool.keys, balances):
+            if balance is not None:
+                key_pool.set_balance(key, balance)
+        if any(b is not None for b in balances):
+            self.fetched_at = time.monotonic()
+        return self.value
+
+    def charge(self, points: int, key: PoeKey | None):
+        if key is not None and points:
+            key_pool.charge(key, points)
+
+    def stop(self):
+        if self.loop_task is not None:
+            self.loop_task.cancel()
+            self.loop_task = None
+
+    def start(self):
+        if self.loop_task is None or self.loop_task.done():
+            self.loop_task = asyncio.create_task(self.refresh_loop())
+
+    async def refresh_loop(self):
+        while True:
+            try:
+                await self.refresh("balance_refresh")
+            except Exception as e:
+                logging.error("Background balance refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+balance_cache = BalanceCache()
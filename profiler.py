@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from config import PROFILE_ENABLED, PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_DIR, PROFILE_MAX_FILES
+
+SAFE_NAME_RE = re.compile(r"[^\w.-]")
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+def suspended_stack(coro):
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return stack
+
+def running_stack(frame):
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class ActiveRequest:
+    def __init__(self, request_id: str, name: str, task, thread_id: int):
+        self.request_id = request_id
+        self.name = name
+        self.task = task
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.samples = Counter()
+
+class RequestProfiler:
+    def __init__(self):
+        self.enabled = PROFILE_ENABLED
+        self.slow_ms = PROFILE_SLOW_MS
+        self.sample_rate = PROFILE_SAMPLE_RATE
+        self.interval = PROFILE_INTERVAL_MS / 1000
+        self.directory = PROFILE_DIR
+        self.max_files = PROFILE_MAX_FILES
+        self.lock = threading.Lock()
+        self.active = {}
+        self.recent = deque(maxlen=50)
+        self.thread = None
+
+    def ensure_sampler(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.sample_loop, name="request-profiler", daemon=True)
+            self.thread.start()
+
+    def sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                active = list(self.active.items())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for key, req in active:
+                try:
+                    coro = req.task.get_coro()
+                    if getattr(coro, "cr_running", False):
+                        stack = running_stack(frames.get(req.thread_id))
+                    else:
+                        stack = suspended_stack(coro)
+                except Exception:
+                    continue
+                if stack:
+                    # profile() pops the request under the lock before record() reads
+                    # the samples, so a finished request is never written to again.
+                    with self.lock:
+                        if self.active.get(key) is req:
+                            req.samples[";".join(stack)] += 1
+
+    @asynccontextmanager
+    async def profile(self, request_id: str, name: str):
+        task = asyncio.current_task() if self.enabled else None
+        if task is None:
+            yield
+            return
+        req = ActiveRequest(request_id, name, task, threading.get_ident())
+        key = (request_id, name, id(req))
+        with self.lock:
+            self.active[key] = req
+        self.ensure_sampler()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.pop(key, None)
+            elapsed_ms = (time.perf_counter() - req.started) * 1000
+            slow = elapsed_ms >= self.slow_ms
+            if slow or random.random() < self.sample_rate:
+                await asyncio.to_thread(self.record, req, elapsed_ms, slow)
+
+    def record(self, req: ActiveRequest, elapsed_ms: float, slow: bool):
+        leaves = Counter()
+        for stack, count in req.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        entry = {
+            "request_id": req.request_id,
+            "name": req.name,
+            "elapsed_ms": int(elapsed_ms),
+            "slow": slow,
+            "at": time.time(),
+            "top_frames": leaves.most_common(5),
+        }
+        self.recent.append(entry)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            label = SAFE_NAME_RE.sub("_", f"{req.request_id}_{req.name}")
+            path = os.path.join(self.directory, f"{int(entry['at'] * 1000)}_{label}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"# {req.request_id} {req.name} {entry['elapsed_ms']}ms\n")
+                for stack, count in req.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.rotate()
+        except Exception as e:
+            logging.error("[%s] Failed to write profile: %s", req.request_id, e)
+
+    def rotate(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith(".folded"))
+        for name in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def recent_slow(self, limit: int = 10):
+        return [e for e in reversed(self.recent) if e["slow"]][:limit]
+
+profiler = RequestProfiler()
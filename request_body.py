@@ -0,0 +1,85 @@
+import base64
+import json
+from aiohttp.payload import Payload
+
+B64_CHUNK = 3 * 16 * 1024
+
+class Base64Source:
+    def __init__(self, file, size: int):
+        self.file = file
+        self.size = size
+
+    @property
+    def encoded_size(self) -> int:
+        return 4 * ((self.size + 2) // 3)
+
+    def chunks(self):
+        # Seek before every read so several requests can stream the same source concurrently.
+        offset = 0
+        while True:
+            self.file.seek(offset)
+            chunk = self.file.read(B64_CHUNK)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield base64.b64encode(chunk)
+
+    def close(self):
+        self.file.close()
+
+class DataUrl:
+    def __init__(self, mime: str, source: Base64Source):
+        self.prefix = f"data:{mime};base64,"
+        self.source = source
+
+def encode_pieces(value, out: list):
+    if isinstance(value, DataUrl):
+        out.append(b'"' + value.prefix.encode())
+        out.append(value.source)
+        out.append(b'"')
+    elif isinstance(value, dict):
+        out.append(b"{")
+        for i, (k, v) in enumerate(value.items()):
+            if i:
+                out.append(b",")
+            out.append(json.dumps(str(k)).encode() + b":")
+            encode_pieces(v, out)
+        out.append(b"}")
+    elif isinstance(value, (list, tuple)):
+        out.append(b"[")
+        for i, v in enumerate(value):
+            if i:
+                out.append(b",")
+            encode_pieces(v, out)
+        out.append(b"]")
+    else:
+        out.append(json.dumps(value).encode())
+    return out
+
+def merge_pieces(pieces: list) -> list:
+    merged = []
+    for piece in pieces:
+        if isinstance(piece, bytes) and merged and isinstance(merged[-1], bytes):
+            merged[-1] += piece
+        else:
+            merged.append(piece)
+    return merged
+
+class JsonStreamPayload(Payload):
+    """JSON body whose DataUrl values are base64-encoded chunk by chunk while writing."""
+
+    def __init__(self, value, **kwargs):
+        self.pieces = merge_pieces(encode_pieces(value, []))
+        super().__init__(value, content_type="application/json", **kwargs)
+        self._size = sum(len(p) if isinstance(p, bytes) else p.encoded_size for p in self.pieces)
+
+    async def write(self, writer):
+        for piece in self.pieces:
+            if isinstance(piece, bytes):
+                await writer.write(piece)
+            else:
+                for chunk in piece.chunks():
+                    await writer.write(chunk)
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return b"".join(p if isinstance(p, bytes) else b"".join(p.chunks()) for p in self.pieces).decode(encoding, errors)
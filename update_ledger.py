@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from config import UPDATE_LEDGER_TTL, UPDATE_LEDGER_HOT_SIZE, UPDATE_LEDGER_PRUNE_INTERVAL
+
+class UpdateLedger:
+    # Remembers which (chat_id, message_id) pairs already reached the model, so a
+    # redelivered update after a crash or restart is not billed twice. Recent
+    # claims are answered from memory; the processed_messages table is the source
+    # of truth across restarts and worker processes.
+    def __init__(self, hot_size: int = UPDATE_LEDGER_HOT_SIZE, ttl: float = UPDATE_LEDGER_TTL):
+        self.hot_size = hot_size
+        self.ttl = ttl
+        self.hot = OrderedDict()
+        # Inserts still running in a thread; release() waits for them so a late
+        # insert cannot re-mark a message that was just released.
+        self.pending = {}
+        self.duplicates = 0
+        self.db = None
+        self.loop_task = None
+
+    def remember(self, key):
+        self.hot[key] = True
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    async def claim(self, chat_id: int, message_id: int, request_id: str = "N/A") -> bool:
+        key = (chat_id, message_id)
+        if key in self.hot:
+            self.duplicates += 1
+            logging.warning("[%s] Message %s was already processed, skipping", request_id, key)
+            return False
+        self.remember(key)
+        if self.db is None:
+            return True
+        insert = asyncio.ensure_future(asyncio.to_thread(self.db.claim_message, chat_id, message_id))
+        self.pending[key] = insert
+        insert.add_done_callback(lambda _: self.forget_insert(key, insert))
+        try:
+            # The thread cannot be cancelled, so a cancelled claim leaves the insert running.
+            claimed = await asyncio.shield(insert)
+        except Exception as e:
+            logging.error("[%s] Failed to record message %s in the ledger, processing anyway: %s", request_id, key, e)
+            return True
+        if not claimed:
+            self.duplicates += 1
+            logging.warning("[%s] Message %s was processed before a restart, skipping", request_id, key)
+        return claimed
+
+    def forget_insert(self, key, insert):
+        if self.pending.get(key) is insert:
+            del self.pending[key]
+
+    async def release(self, chat_id: int, message_id: int):
+        insert = self.pending.get((chat_id, message_id))
+        if insert is not None:
+            await asyncio.wait({insert})
+        self.hot.pop((chat_id, message_id), None)
+        if self.db is not None:
+            try:
+                await asyncio.to_thread(self.db.release_message, chat_id, message_id)
+            except Exception as e:
+                logging.error("Failed to release message %s from the ledger: %s", (chat_id, message_id), e)
+
+    def stop(self):
+        if self.loop_task is not None:
+            self.loop_task.cancel()
+            self.loop_task = None
+
+    def start(self, db):
+        self.db = db
+        if self.loop_task is None or self.loop_task.done():
+            self.loop_task = asyncio.create_task(self.prune_loop())
+
+    async def prune_loop(self):
+        while True:
+            try:
+                deleted = await asyncio.to_thread(self.db.prune_processed_messages, self.ttl)
+                if deleted:
+                    logging.info("Pruned %s expired entries from the message ledger", deleted)
+            except Exception as e:
+                logging.error("Message ledger pruning failed: %s", e)
+            await asyncio.sleep(UPDATE_LEDGER_PRUNE_INTERVAL)
+
+update_ledger = UpdateLedger()
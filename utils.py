@@ -4,80 +4,175 @@ from telegramify_markdown import customize
 
 MDV2_SPECIALS = r"_*[]()~`>#+-=|{}.!"
 
-def post_process_response_text(text: str) -> str:
-    if not text:
-        return ""
-    lines = text.split("\n")
-    processed = []
-    in_thinking_block = False
-    for i, line in enumerate(lines):
+THINKING_MARKER = "*Thinking...*"
+SOURCES_MARKERS = ("Learn more:", "Related searches:")
+SOURCES_NOTICE = "**Для данного запроса использовался интернет. Источники были скрыты.**"
+DISCLAIMER = (
+    "This response may include content that is harmful, illegal, or inappropriate. "
+    "Please proceed with caution and adhere to relevant guidelines and laws. "
+    "All information is provided for reference and academic purposes only."
+)
+CITATION_RE = re.compile(r"\[\d+(?:,\s*\d+)*\]")
+EMPTY_HEADER_RE = re.compile(r"^#{1,6}\s*$")
+FENCE_TAIL_RE = re.compile(r"```[ \t]*$")
+FENCE_HEAD_RE = re.compile(r"^[ \t]*```")
+BALANCE_RE = re.compile(r"[*_~`]")
+BALANCE_SYMBOLS = "*_~`"
+
+class ResponseCleaner:
+    # Single pass over the reply, line by line, usable on streamed chunks:
+    # thinking/citation/disclaimer stripping, trailing whitespace trim,
+    # empty fence and header removal, blank-line collapsing and markup balancing.
+    # Only the minimum needed for lookahead is held back between feed() calls.
+    def __init__(self):
+        self.partial = ""
+        self.done = False
+        self.in_thinking = False
+        self.rule_line = None
+        self.held = []
+        self.fence_line = None
+        self.fence_at = None
+        self.in_code = False
+        self.empty_run = 0
+        self.started = False
+        self.tail = ""
+        self.counts = dict.fromkeys(BALANCE_SYMBOLS, 0)
+        self.out = []
+
+    def feed(self, chunk: str) -> str:
+        if chunk:
+            lines = (self.partial + chunk).split("\n")
+            self.partial = lines.pop()
+            for line in lines:
+                self.filter_line(line)
+        return self.flush_out()
+
+    def finish(self) -> str:
+        self.filter_line(self.partial)
+        self.partial = ""
+        if self.rule_line is not None:
+            self.hold_line(self.clean_line(self.rule_line))
+            self.rule_line = None
+        if self.held:
+            self.merge_fences(self.held[0].rstrip())
+            self.held = []
+        if self.fence_line is not None:
+            self.normalize_line(self.fence_line)
+            self.fence_line = None
+        tail = self.tail
+        for symbol in BALANCE_SYMBOLS:
+            if self.counts[symbol] % 2 == 1:
+                idx = tail.rfind(symbol)
+                if idx != -1:
+                    tail = tail[:idx] + tail[idx + 1:]
+        self.tail = ""
+        self.out.append(tail)
+        return self.flush_out()
+
+    def flush_out(self) -> str:
+        text = "".join(self.out)
+        self.out = []
+        return text
+
+    def clean_line(self, line: str) -> str:
+        return CITATION_RE.sub("", line).replace(DISCLAIMER, "")
+
+    def filter_line(self, line: str):
+        if self.done:
+            return
+        if self.rule_line is not None:
+            rule, self.rule_line = self.rule_line, None
+            if line.strip() in SOURCES_MARKERS:
+                self.hold_line(SOURCES_NOTICE)
+                self.done = True
+                return
+            self.hold_line(self.clean_line(rule))
         stripped = line.strip()
-        if stripped == "*Thinking...*":
-            continue
-        if stripped.startswith(">") and not in_thinking_block:
-            in_thinking_block = True
-            continue
-        if in_thinking_block:
+        if stripped == THINKING_MARKER:
+            return
+        if stripped.startswith(">") and not self.in_thinking:
+            self.in_thinking = True
+            return
+        if self.in_thinking:
             if stripped and stripped.startswith(">"):
-                continue
-            in_thinking_block = False
-        if stripped == "---" and i + 1 < len(lines) and lines[i + 1].strip() in ("Learn more:", "Related searches:"):
-            processed.append("**Для данного запроса использовался интернет. Источники были скрыты.**")
-            break
-        
-        line = re.sub(r"\[\d+(?:,\s*\d+)*\]", "", line)
-
-        processed.append(line)
-    processed_text = "\n".join(processed)
-    disclaimer = (
-        "This response may include content that is harmful, illegal, or inappropriate. "
-        "Please proceed with caution and adhere to relevant guidelines and laws. "
-        "All information is provided for reference and academic purposes only."
-    )
-    processed_text = processed_text.replace(disclaimer, "")
-    return processed_text.rstrip()
+                return
+            self.in_thinking = False
+        if stripped == "---":
+            self.rule_line = line
+            return
+        self.hold_line(self.clean_line(line))
+
+    def hold_line(self, line: str):
+        if not line.strip():
+            self.held.append(line)
+            return
+        for h in self.held:
+            self.merge_fences(h)
+        self.held = [line]
+
+    def merge_fences(self, line: str):
+        if self.fence_line is not None:
+            head = FENCE_HEAD_RE.match(line)
+            if head:
+                rest = line[head.end():]
+                prefix = self.fence_line[:self.fence_at]
+                self.fence_line = prefix + rest
+                tail = FENCE_TAIL_RE.search(rest)
+                if tail:
+                    self.fence_at = len(prefix) + tail.start()
+                else:
+                    self.normalize_line(self.fence_line)
+                    self.fence_line = None
+                return
+            self.normalize_line(self.fence_line)
+            self.fence_line = None
+        tail = FENCE_TAIL_RE.search(line)
+        if tail:
+            self.fence_line = line
+            self.fence_at = tail.start()
+            return
+        self.normalize_line(line)
+
+    def normalize_line(self, line: str):
+        if EMPTY_HEADER_RE.match(line):
+            line = ""
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            self.in_code = not self.in_code
+            self.empty_run = 0
+        elif not self.in_code:
+            if stripped == "":
+                self.empty_run += 1
+                if self.empty_run > 1:
+                    return
+            else:
+                self.empty_run = 0
+        self.balance_text(line if not self.started else "\n" + line)
+        self.started = True
 
-def markdown_normalize(text: str) -> str:
+    def balance_text(self, text: str):
+        base = len(self.tail)
+        self.tail += text
+        last = {}
+        for m in BALANCE_RE.finditer(text):
+            symbol = m.group(0)
+            self.counts[symbol] += 1
+            last[symbol] = base + m.start()
+        hold = len(self.tail)
+        for symbol in BALANCE_SYMBOLS:
+            if self.counts[symbol] % 2 == 1:
+                idx = last[symbol] if symbol in last else self.tail.rfind(symbol)
+                if idx != -1 and idx < hold:
+                    hold = idx
+        if hold:
+            self.out.append(self.tail[:hold])
+            self.tail = self.tail[hold:]
+
+def clean_response_text(text: str) -> str:
     if not text:
         return ""
-    text = re.sub(r"```[ \t]*\n[ \t]*```", "", text)
-    def fix_headers(line: str) -> str:
-        if re.match(r"^#{1,6}\s*$", line):
-            return ""
-        return line
-    lines = [fix_headers(l) for l in text.split("\n")]
-    normalized = []
-    empty_run = 0
-    in_code = False
-    for l in lines:
-        if l.strip().startswith("```"):
-            in_code = not in_code
-            normalized.append(l)
-            empty_run = 0
-            continue
-        if in_code:
-            normalized.append(l)
-            continue
-        if l.strip() == "":
-            empty_run += 1
-            if empty_run <= 1:
-                normalized.append(l)
-        else:
-            empty_run = 0
-            normalized.append(l)
-    text = "\n".join(normalized)
-    def balance(symbol: str, s: str) -> str:
-        cnt = s.count(symbol)
-        if cnt % 2 == 1:
-            idx = s.rfind(symbol)
-            if idx != -1:
-                s = s[:idx] + s[idx+1:]
-        return s
-    text = balance("*", text)
-    text = balance("_", text)
-    text = balance("~", text)
-    text = balance("`", text)
-    return text
+    cleaner = ResponseCleaner()
+    return cleaner.feed(text) + cleaner.finish()
 
 def sanitize_markdown_v2(text: str) -> str:
     if text is None:
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from config import SHUTDOWN_DRAIN_TIMEOUT, WORKER_REPORT_INTERVAL
+import handlers_shared
+from app import configure_proxy_env, create_bot, create_dispatcher, start_services, apply_event
+from lifecycle import inflight
+from logging_setup import setup_logging
+
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query"]
+
+def update_chat_id(update: dict) -> int:
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from")
+        if user:
+            return user["id"]
+    return update.get("update_id", 0)
+
+def shard_for(update: dict, workers: int) -> int:
+    return update_chat_id(update) % workers
+
+def worker_main(index: int, updates, events):
+    setup_logging(f"[w{index}] ")
+    # The supervisor owns shutdown: Ctrl+C and a control-group SIGTERM reach every
+    # process at once, and workers must keep draining until they get the sentinel.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(run_worker(index, updates, events))
+
+async def run_worker(index: int, updates, events):
+    configure_proxy_env()
+    bot = create_bot()
+    dp = create_dispatcher()
+    handlers_shared.broadcast = lambda event: events.put(("event", index, event))
+    await start_services(primary=index == 0)
+    loop = asyncio.get_running_loop()
+    handled = 0
+    last_report = time.monotonic()
+    logging.info("Worker %s started (pid %s)", index, os.getpid())
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, updates.get, True, 1.0)
+            except queue.Empty:
+                data = False
+            if data is None:
+                break
+            if isinstance(data, tuple):
+                apply_event(data[1])
+            elif data:
+                inflight.spawn(dp.feed_raw_update(bot, data))
+                handled += 1
+            if time.monotonic() - last_report >= WORKER_REPORT_INTERVAL:
+                events.put(("load", index, os.getpid(), len(inflight.tasks), handled))
+                last_report = time.monotonic()
+    finally:
+        # on_shutdown drains inflight, which includes every update task spawned above.
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+def start_worker(ctx, index: int, queues, events):
+    process = ctx.Process(target=worker_main, args=(index, queues[index], events), name=f"worker-{index}")
+    process.start()
+    return process
+
+def relay_event(item, queues, load: dict):
+    if item[0] == "event":
+        _, source, event = item
+        for index, q in enumerate(queues):
+            if index != source:
+                q.put(("event", event))
+    else:
+        _, index, pid, inflight_count, handled = item
+        load[index] = (pid, inflight_count, handled)
+
+async def relay_events(queues, events, load: dict, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        try:
+            item = await loop.run_in_executor(None, events.get, True, 1.0)
+        except queue.Empty:
+            continue
+        relay_event(item, queues, load)
+
+def flush_events(queues, events, load: dict):
+    while True:
+        try:
+            item = events.get_nowait()
+        except queue.Empty:
+            return
+        relay_event(item, queues, load)
+
+async def monitor_workers(ctx, processes, queues, events, load: dict, stop: asyncio.Event):
+    last_report = time.monotonic()
+    while not stop.is_set():
+        await asyncio.sleep(5)
+        for index, process in enumerate(processes):
+            if not process.is_alive() and not stop.is_set():
+                logging.error("Worker %s (pid %s) exited with code %s, restarting", index, process.pid, process.exitcode)
+                processes[index] = start_worker(ctx, index, queues, events)
+        if time.monotonic() - last_report >= WORKER_REPORT_INTERVAL:
+            parts = []
+            for index in range(len(processes)):
+                pid, inflight_count, handled = load.get(index, (processes[index].pid, "?", "?"))
+                try:
+                    backlog = queues[index].qsize()
+                except NotImplementedError:
+                    backlog = "?"
+                parts.append(f"w{index}(pid {pid}): in-flight {inflight_count}, handled {handled}, queued {backlog}")
+            logging.info("Worker load: %s", "; ".join(parts))
+            last_report = time.monotonic()
+
+async def stop_workers(processes, queues, timeout: float):
+    for index, process in processes:
+        queues[index].put(None)
+    deadline = time.monotonic() + timeout
+    for index, process in processes:
+        await asyncio.to_thread(process.join, max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.warning("Worker %s (pid %s) did not stop in time, killing", index, process.pid)
+            process.kill()
+
+async def poll_updates(bot, queues, stop: asyncio.Event):
+    offset = None
+    stop_waiter = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        fetch = asyncio.create_task(bot.get_updates(offset=offset, timeout=25, allowed_updates=ALLOWED_UPDATES))
+        await asyncio.wait({fetch, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        if not fetch.done():
+            fetch.cancel()
+            break
+        try:
+            updates = fetch.result()
+        except Exception as e:
+            logging.error("Failed to fetch updates: %s", e)
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            data = update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+            queues[shard_for(data, len(queues))].put(data)
+            offset = update.update_id + 1
+
+async def supervise(ctx, queues, events):
+    configure_proxy_env()
+    processes = [start_worker(ctx, i, queues, events) for i in range(len(queues))]
+    bot = create_bot()
+    stop = asyncio.Event()
+    if sys.platform != 'win32':
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    load = {}
+    relay = asyncio.create_task(relay_events(queues, events, load, stop))
+    monitor = asyncio.create_task(monitor_workers(ctx, processes, queues, events, load, stop))
+    try:
+        await bot.delete_webhook(drop_pending_updates=False)
+        logging.info("Supervisor polling for %s workers", len(queues))
+        await poll_updates(bot, queues, stop)
+    finally:
+        stop.set()
+        monitor.cancel()
+        await relay
+        logging.info("Supervisor stopping, waiting for workers to drain...")
+        # Worker 0 checkpoints budgets, so it stops last and still receives the
+        # charges the other workers make while draining.
+        timeout = SHUTDOWN_DRAIN_TIMEOUT + 30
+        await stop_workers(list(enumerate(processes))[1:], queues, timeout)
+        flush_events(queues[:1], events, load)
+        await stop_workers([(0, processes[0])], queues, timeout)
+        await bot.session.close()
+
+def run_supervisor(workers: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    events = ctx.Queue()
+    asyncio.run(supervise(ctx, queues, events))